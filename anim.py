@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Routines for writing animations, one frame at a time.
+
+"""
+
+__all__ = (
+    'GifWriter',
+    'open_animation',
+    'VideoWriter',
+)
+
+import collections
+import multiprocessing
+import os
+import struct
+
+import cv2
+import numpy
+
+# GIF images have a maximum LZW code size of 12 bits.
+_MAX_CODES = 4096
+
+def _lzw_encode(data):
+    """
+    LZW compress a string of 8-bit pixel values, as for a GIF image with a
+    minimum code size of 8.
+
+    This is pure Python, so takes roughly a quarter of a second per megapixel.
+
+    """
+    clear_code = 256
+    end_code = 257
+
+    out = bytearray()
+    bits, num_bits = clear_code, 9
+
+    # The table maps a string, given as the code of its prefix and its last
+    # byte packed into one integer, to its code. Single bytes are their own
+    # codes.
+    table = {}
+    next_code, code_size = end_code + 1, 9
+
+    data = bytearray(data)
+    codes = []
+    if data:
+        w = data[0]
+        for c in data[1:]:
+            key = (w << 8) | c
+            code = table.get(key)
+            if code is not None:
+                w = code
+                continue
+
+            bits |= w << num_bits
+            num_bits += code_size
+            while num_bits >= 8:
+                out.append(bits & 0xff)
+                bits >>= 8
+                num_bits -= 8
+
+            if next_code < _MAX_CODES:
+                table[key] = next_code
+                next_code += 1
+                # The decoder adds codes one step behind the encoder, so the
+                # code size increases once the next code no longer fits.
+                if next_code > (1 << code_size) and code_size < 12:
+                    code_size += 1
+            else:
+                bits |= clear_code << num_bits
+                num_bits += code_size
+                table = {}
+                next_code, code_size = end_code + 1, 9
+            w = c
+        codes.append(w)
+    codes.append(end_code)
+
+    for code in codes:
+        bits |= code << num_bits
+        num_bits += code_size
+        while num_bits >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            num_bits -= 8
+    if num_bits > 0:
+        out.append(bits & 0xff)
+
+    return bytes(out)
+
+def _sub_blocks(data):
+    """Split data into GIF sub-blocks, followed by a block terminator."""
+    return (''.join(chr(len(data[i:i + 255])) + data[i:i + 255]
+                        for i in range(0, len(data), 255)) +
+            '\x00')
+
+def _encode_frame(data):
+    """
+    Return the compressed image data for a frame.
+
+    This is run in `GifWriter`'s worker processes.
+
+    """
+    return _sub_blocks(_lzw_encode(data))
+
+class GifWriter(object):
+    """
+    Writes a looping, grayscale animated GIF, one frame at a time.
+
+    All frames share a single global palette of 256 gray levels, so frames are
+    written without any quantization. Frames are written as they are added,
+    so the whole animation is never held in memory.
+
+    Compressing a frame is slow (see `_lzw_encode`), so frames are compressed
+    in a pool of worker processes, rather than holding the GIL in the calling
+    process. Frames are compressed independently, so with more than one
+    process several frames are compressed at once. They are still written in
+    the order they were added.
+
+    """
+
+    def __init__(self, path, delay=5, delta=False, processes=1):
+        """
+        Initialize a new GifWriter.
+
+        Arguments:
+            path: Output file path.
+            delay: Delay between frames, in hundredths of a second.
+            delta: If True, each frame only encodes the rectangle which has
+                changed since the previous frame.
+            processes: Number of worker processes used to compress frames.
+                Up to twice this many frames are held, compressed or
+                waiting to be compressed, before `add_frame` blocks.
+
+        """
+        self._path = path
+        self._delay = delay
+        self._delta = delta
+        self._f = None
+        self._prev = None
+        self._max_pending = 2 * processes
+        self._pending = collections.deque()
+        self._pool = multiprocessing.Pool(processes)
+
+    def _write_header(self, shape):
+        h, w = shape
+        self._f = open(self._path, 'wb')
+        self._f.write('GIF89a')
+        # Logical screen descriptor, with a global color table of 256 entries.
+        self._f.write(struct.pack('<HHBBB', w, h, 0xf7, 0, 0))
+        self._f.write(''.join(chr(i) * 3 for i in range(256)))
+        # Loop forever.
+        self._f.write('\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def add_frame(self, im):
+        """Append a frame. All frames must be the same size."""
+        if self._f is None:
+            self._write_header(im.shape)
+        elif im.shape != self._prev.shape:
+            raise ValueError("Frame size {} does not match {}".format(
+                                                   im.shape, self._prev.shape))
+
+        x0, y0, x1, y1 = 0, 0, im.shape[1], im.shape[0]
+        if self._delta and self._prev is not None:
+            changed = im != self._prev
+            rows = numpy.flatnonzero(changed.any(axis=1))
+            cols = numpy.flatnonzero(changed.any(axis=0))
+            if len(rows) == 0:
+                # Nothing has changed, but a frame is still needed to keep the
+                # timing. Re-encode a single pixel.
+                x0, y0, x1, y1 = 0, 0, 1, 1
+            else:
+                x0, y0, x1, y1 = cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+        # Graphic control extension. Disposal method 1 leaves the previous
+        # frame in place, so delta frames are drawn on top of it.
+        header = struct.pack('<BBBBHBB', 0x21, 0xf9, 4, 1 << 2, self._delay,
+                             0, 0)
+        # Image descriptor, then the image data.
+        header += struct.pack('<BHHHHB', 0x2c, x0, y0, x1 - x0, y1 - y0, 0)
+        header += '\x08'
+        data = numpy.ascontiguousarray(im[y0:y1, x0:x1],
+                                       dtype=numpy.uint8).tobytes()
+        self._pending.append(
+                  (header, self._pool.apply_async(_encode_frame, (data,))))
+        while len(self._pending) > self._max_pending:
+            self._write_pending()
+
+        self._prev = numpy.array(im, dtype=numpy.uint8)
+
+    def _write_pending(self):
+        header, result = self._pending.popleft()
+        self._f.write(header)
+        self._f.write(result.get())
+
+    def close(self):
+        try:
+            while self._pending:
+                self._write_pending()
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+        if self._f is not None:
+            self._f.write('\x3b')
+            self._f.close()
+
+class VideoWriter(object):
+    """
+    Writes a grayscale video, one frame at a time, using `cv2.VideoWriter`.
+
+    """
+
+    def __init__(self, path, delay=5, codec='MJPG'):
+        """
+        Initialize a new VideoWriter.
+
+        Arguments:
+            path: Output file path. The container is determined by the
+                extension.
+            delay: Delay between frames, in hundredths of a second.
+            codec: Four character code of the video codec.
+
+        """
+        self._path = path
+        self._fps = 100. / delay
+        self._codec = codec
+        self._writer = None
+
+    def add_frame(self, im):
+        """Append a frame. All frames must be the same size."""
+        if self._writer is None:
+            if hasattr(cv2, 'VideoWriter_fourcc'):
+                fourcc = cv2.VideoWriter_fourcc(*self._codec)
+            else:
+                fourcc = cv2.cv.CV_FOURCC(*self._codec)
+            self._writer = cv2.VideoWriter(self._path, fourcc, self._fps,
+                                           (im.shape[1], im.shape[0]),
+                                           isColor=False)
+            if not self._writer.isOpened():
+                raise IOError("Could not open {} for writing".format(
+                                                                  self._path))
+        self._writer.write(im)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+
+def open_animation(path, delay=5, delta=False, processes=1):
+    """
+    Return a writer for an animation, based on the extension of `path`.
+
+    '.gif' files are written with `GifWriter`, whereas anything else is passed
+    to `VideoWriter`. Video codecs do their own inter-frame compression, so
+    `delta` and `processes` only affect GIFs.
+
+    """
+    if os.path.splitext(path)[1].lower() == '.gif':
+        return GifWriter(path, delay=delay, delta=delta, processes=processes)
+    return VideoWriter(path, delay=delay)
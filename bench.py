@@ -0,0 +1,588 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Benchmarks for star extraction, registration and stacking.
+
+The LORRI imagery isn't needed: frames are generated from a random star field
+with known sub-pixel star positions, a bright target body, sensor noise, and
+known rotations and translations between frames. Each benchmark reports
+timings along with the error against the ground truth, so that regressions in
+speed or correctness can be caught offline.
+
+"""
+
+__all__ = (
+    'SyntheticSequence',
+    'bench_batched',
+    'bench_extract',
+    'bench_register_many',
+    'bench_register_pair',
+    'bench_stack',
+)
+
+import json
+import math
+import random
+import sys
+import timeit
+
+import numpy
+
+import reg
+import stack
+import stars
+
+# Standard deviation of the (Gaussian) point spread function, in pixels.
+STAR_SIGMA = 1.2
+
+# Range of star peak brightnesses.
+MIN_STAR_PEAK = 60.
+MAX_STAR_PEAK = 250.
+
+# Background level, and standard deviation of the sensor noise.
+BACKGROUND = 5.
+NOISE_LEVEL = 0.6
+
+# Radius of the target body, as a fraction of the frame width, and its
+# brightness.
+BODY_RADIUS = 0.06
+BODY_BRIGHTNESS = 180.
+
+# Standard deviations of the per-frame change in rotation (radians) and
+# translation (pixels). Frames form a random walk from the first frame.
+ROTATION_STEP = 0.01
+TRANSLATION_STEP = 2.
+
+# For registration benchmarks, star positions are perturbed by this much
+# (standard deviation, in pixels), fluxes are perturbed by this fraction, this
+# fraction of stars is dropped from each frame, and this many spurious stars
+# (fainter than any real star) are added to each frame.
+POSITION_JITTER = 0.1
+FLUX_JITTER = 0.1
+DROPOUT_FRACTION = 0.1
+NUM_SPURIOUS = 2
+
+# An extracted star within this distance of a true star counts as a match.
+MATCH_DISTANCE = 1.0
+
+# True stars with another star closer than this are counted as unresolved.
+# Extraction's dilation step tends to merge such stars into one.
+MIN_RESOLVED_SEPARATION = 2 * stars.DILATION_SIZE
+
+# Accuracy limits used by `--check`: the maximum distance by which a frame's
+# corners may be misplaced by a registration, the maximum mean absolute
+# difference between a stacked frame and the reference frame, and the minimum
+# fraction of stars that extraction must find. Stars closer together than the
+# dilation size are merged by extraction, so some are always missed in dense
+# fields.
+MAX_CORNER_ERROR = 1.0
+MAX_STACK_ERROR = 2.0
+MIN_RECALL = 0.7
+
+# Each timing is the best of this many runs.
+REPEATS = 3
+
+def _rotation_matrix(theta, centre, offset):
+    """
+    Return a matrix which rotates by `theta` about `centre`, and then
+    translates by `offset`.
+
+    """
+    c, s = math.cos(theta), math.sin(theta)
+    R = numpy.matrix([[c, -s], [s, c]])
+    centre = numpy.matrix(centre, dtype=numpy.float64).T
+    T = centre - R * centre + numpy.matrix(offset, dtype=numpy.float64).T
+
+    return numpy.vstack([numpy.hstack([R, T]), numpy.matrix([0., 0., 1.])])
+
+class SyntheticSequence(object):
+    """
+    A sequence of synthetic LORRI-like frames with known ground truth.
+
+    Star positions are defined in the coordinate frame of the first frame
+    (the reference frame). `transform(i)` converts points in the reference
+    frame into frame `i`'s coordinate frame, as returned by
+    `reg.register_many` and accepted by `stack.StackedImage.add_image`. The
+    target body stays in the centre of each frame, as it would if the
+    spacecraft is tracking it, so it does not move with the stars.
+
+    """
+
+    def __init__(self, num_stars=30, size=(512, 512), num_frames=2, seed=0):
+        """
+        Initialize a new SyntheticSequence.
+
+        Arguments:
+            num_stars: Number of stars in the reference frame.
+            size: `(height, width)` of each frame.
+            num_frames: Number of frames in the sequence.
+            seed: Seed for the random number generator. Sequences with the
+                same arguments are identical.
+
+        """
+        self.size = size
+        self.num_frames = num_frames
+        self._seed = seed
+        rng = numpy.random.RandomState(seed)
+
+        margin = 4 * STAR_SIGMA
+        self._positions = numpy.column_stack([
+                           rng.uniform(margin, size[1] - margin, num_stars),
+                           rng.uniform(margin, size[0] - margin, num_stars)])
+        self._peaks = rng.uniform(MIN_STAR_PEAK, MAX_STAR_PEAK, num_stars)
+
+        centre = (size[1] / 2., size[0] / 2.)
+        self._transforms = [numpy.matrix(numpy.identity(3))]
+        theta, offset = 0., numpy.zeros(2)
+        for i in range(1, num_frames):
+            theta += rng.normal(0., ROTATION_STEP)
+            offset += rng.normal(0., TRANSLATION_STEP, 2)
+            self._transforms.append(_rotation_matrix(theta, centre, offset))
+
+    def transform(self, i):
+        """Return the transformation from the reference frame to frame `i`."""
+        return self._transforms[i]
+
+    def positions(self, i):
+        """
+        Return the positions of the stars visible in frame `i`.
+
+        Returns:
+            An `(N, 2)` array of `(x, y)` coordinates, and an array of the
+            `N` corresponding star peak brightnesses. Stars which are outside
+            the frame or hidden behind the target body are excluded.
+
+        """
+        M = numpy.asarray(self._transforms[i])
+        points = numpy.dot(self._positions, M[:2, :2].T) + M[:2, 2]
+
+        margin = 4 * STAR_SIGMA
+        h, w = self.size
+        body_dist = numpy.hypot(points[:, 0] - w / 2., points[:, 1] - h / 2.)
+        visible = ((points[:, 0] >= margin) & (points[:, 0] < w - margin) &
+                   (points[:, 1] >= margin) & (points[:, 1] < h - margin) &
+                   (body_dist > BODY_RADIUS * w + margin))
+
+        return points[visible], self._peaks[visible]
+
+    def stars(self, i):
+        """
+        Return a `stars.StarSet` for frame `i`, as a star extractor might.
+
+        Positions are perturbed by `POSITION_JITTER`, and fluxes by
+        `FLUX_JITTER`. `DROPOUT_FRACTION` of the stars are removed, and
+        `NUM_SPURIOUS` spurious stars are added.
+
+        """
+        rng = numpy.random.RandomState([self._seed, i, 1])
+        points, peaks = self.positions(i)
+        points = points + rng.normal(0., POSITION_JITTER, points.shape)
+        fluxes = (2 * math.pi * STAR_SIGMA ** 2 * peaks *
+                  rng.normal(1., FLUX_JITTER, len(peaks)))
+        keep = rng.uniform(size=len(points)) >= DROPOUT_FRACTION
+        points, fluxes = points[keep], fluxes[keep]
+
+        spurious = rng.uniform(0, 1, (NUM_SPURIOUS, 2)) * self.size[::-1]
+        points = numpy.vstack([points, spurious])
+        fluxes = numpy.append(fluxes, rng.uniform(
+                  0, 2 * math.pi * STAR_SIGMA ** 2 * MIN_STAR_PEAK,
+                  NUM_SPURIOUS))
+        order = rng.permutation(len(points))
+
+        out = numpy.empty(len(points), dtype=stars.STAR_DTYPE)
+        out['x'] = points[order, 0]
+        out['y'] = points[order, 1]
+        out['flux'] = fluxes[order]
+        out['area'] = -1
+
+        return stars.StarSet(out)
+
+    def render(self, i, noise=True, body=True):
+        """
+        Render frame `i` as a uint8 image.
+
+        Arguments:
+            i: Index of the frame.
+            noise: If False, the background is a constant `BACKGROUND` level.
+            body: If False, the target body is omitted.
+
+        """
+        h, w = self.size
+        im = numpy.full((h, w), BACKGROUND)
+        if noise:
+            rng = numpy.random.RandomState([self._seed, i, 2])
+            im += rng.normal(0., NOISE_LEVEL, (h, w))
+
+        # Only a small patch around each star is computed.
+        r = int(math.ceil(4 * STAR_SIGMA))
+        for (x, y), peak in zip(*self.positions(i)):
+            x0, y0 = int(x) - r, int(y) - r
+            yy, xx = numpy.mgrid[y0:y0 + 2 * r + 1, x0:x0 + 2 * r + 1]
+            im[y0:y0 + 2 * r + 1, x0:x0 + 2 * r + 1] += peak * numpy.exp(
+                      -((xx - x) ** 2 + (yy - y) ** 2) / (2 * STAR_SIGMA ** 2))
+
+        if body:
+            yy, xx = numpy.mgrid[0:h, 0:w]
+            d = numpy.hypot(xx - w / 2., yy - h / 2.) / (BODY_RADIUS * w)
+            im[d < 1] = BODY_BRIGHTNESS * numpy.sqrt(1 - d[d < 1] ** 2) + 20
+
+        return numpy.clip(im, 0, 255).astype(numpy.uint8)
+
+def _time(func, repeats=REPEATS):
+    """
+    Call a function `repeats` times.
+
+    Returns:
+        The best time in seconds, and the value returned by the last call.
+
+    """
+    best = None
+    for _ in range(repeats):
+        start = timeit.default_timer()
+        out = func()
+        t = timeit.default_timer() - start
+        best = t if best is None else min(best, t)
+
+    return best, out
+
+def _corner_error(M, M_true, size):
+    """
+    Return the greatest distance between a frame's corners, as projected by an
+    estimated transformation and by the true transformation.
+
+    """
+    h, w = size
+    corners = numpy.matrix([[0, w, 0, w], [0, 0, h, h], [1, 1, 1, 1]],
+                           dtype=numpy.float64)
+    diff = numpy.asarray((M - M_true) * corners)[:2]
+
+    return float(numpy.max(numpy.hypot(diff[0], diff[1])))
+
+def bench_extract(sizes, star_counts, methods=stars.METHODS):
+    """
+    Time `stars.extract`, and check the extracted positions.
+
+    Returns:
+        A list of dicts, one per combination of the arguments. Each has the
+        time taken, the fraction of visible stars found, the RMS position
+        error of those found, and the number of spurious stars. The target
+        body is expected to be one of the spurious stars. The number of
+        unresolved stars (see `MIN_RESOLVED_SEPARATION`), and the fraction of
+        them found, are also reported.
+
+    """
+    rows = []
+    for size in sizes:
+        for num_stars in star_counts:
+            seq = SyntheticSequence(num_stars=num_stars, size=(size, size),
+                                    num_frames=1)
+            im = seq.render(0)
+            true_points, _ = seq.positions(0)
+            separations = numpy.hypot(
+                       true_points[:, None, 0] - true_points[None, :, 0],
+                       true_points[:, None, 1] - true_points[None, :, 1])
+            numpy.fill_diagonal(separations, numpy.inf)
+            unresolved = separations.min(axis=1) < MIN_RESOLVED_SEPARATION
+            for method in methods:
+                row = {'benchmark': 'extract', 'size': size,
+                       'stars': len(true_points), 'method': method}
+                try:
+                    row['time'], found = _time(
+                              lambda: stars.extract(im, method=method))
+                except stars.ExtractFailed as e:
+                    row['error'] = str(e)
+                    rows.append(row)
+                    continue
+
+                found = found.positions
+                dists = numpy.hypot(
+                       found[:, None, 0] - true_points[None, :, 0],
+                       found[:, None, 1] - true_points[None, :, 1]).min(axis=0)
+                matched = dists < MATCH_DISTANCE
+                row['recall'] = float(numpy.mean(matched))
+                row['unresolved'] = int(numpy.sum(unresolved))
+                row['unresolved_recall'] = (
+                                 float(numpy.mean(matched[unresolved]))
+                                 if numpy.any(unresolved) else None)
+                row['rms_error'] = (float(numpy.sqrt(numpy.mean(
+                                                     dists[matched] ** 2)))
+                                    if numpy.any(matched) else None)
+                row['spurious'] = len(found) - int(numpy.sum(matched))
+                rows.append(row)
+
+    return rows
+
+def bench_register_pair(star_counts, matchers=reg.MATCHERS, size=512,
+                        verify=True):
+    """
+    Time `reg.register_pair`, and check the transformation found.
+
+    `verify` is passed to `reg.register_pair`.
+
+    Returns:
+        A list of dicts, one per combination of the arguments. Each has the
+        time taken, the RANSAC (or hashing) iterations, and the corner error
+        of the transformation (see `_corner_error`).
+
+    """
+    rows = []
+    for num_stars in star_counts:
+        seq = SyntheticSequence(num_stars=num_stars, size=(size, size),
+                                num_frames=2)
+        stars1, stars2 = seq.stars(0), seq.stars(1)
+        for matcher in matchers:
+            row = {'benchmark': 'register_pair', 'size': size,
+                   'stars': num_stars, 'matcher': matcher, 'verify': verify}
+            stats = {}
+            def run():
+                random.seed(0)
+                return reg.register_pair(stars1, stars2, matcher=matcher,
+                                         stats=stats, verify=verify)
+            try:
+                row['time'], M = _time(run)
+            except reg.RegistrationFailed:
+                row['error'] = "Registration failed"
+            else:
+                row['corner_error'] = _corner_error(M, seq.transform(1),
+                                                    seq.size)
+            row['iterations'] = stats.get('iterations')
+            rows.append(row)
+
+    return rows
+
+def bench_register_many(lengths, matchers=reg.MATCHERS, num_stars=30,
+                        size=512, verify=True):
+    """
+    Time `reg.register_many` over whole sequences.
+
+    `verify` is passed to `reg.register_many`.
+
+    Returns:
+        A list of dicts, one per combination of the arguments. Each has the
+        total time taken, the number of frames which failed to register, and
+        the greatest corner error over the registered frames.
+
+    """
+    rows = []
+    for length in lengths:
+        seq = SyntheticSequence(num_stars=num_stars, size=(size, size),
+                                num_frames=length)
+        stars_seq = [seq.stars(i) for i in range(length)]
+        for matcher in matchers:
+            row = {'benchmark': 'register_many', 'size': size,
+                   'stars': num_stars, 'frames': length, 'matcher': matcher,
+                   'verify': verify}
+            def run():
+                random.seed(0)
+                return list(reg.register_many(stars_seq, matcher=matcher,
+                                              verify=verify))
+            row['time'], results = _time(run, repeats=1)
+            errors = [_corner_error(r.transform, seq.transform(i), seq.size)
+                        for i, r in enumerate(results)
+                        if r.exception is None]
+            row['failed'] = sum(1 for r in results if r.exception is not None)
+            row['corner_error'] = max(errors)
+            rows.append(row)
+
+    return rows
+
+def bench_stack(sizes, num_frames=10):
+    """
+    Time `stack.StackedImage.add_image`, and check the stacked output.
+
+    Frames are stacked using their true transformations, into an output image
+    which bounds all of the frames.
+
+    Returns:
+        A list of dicts, one per frame size. Each has the mean time per
+        `add_image` call, and the greatest mean absolute difference between a
+        noise-free frame stacked on its own, and the noise-free reference
+        frame, over the pixels the frame covers.
+
+    """
+    rows = []
+    for size in sizes:
+        seq = SyntheticSequence(size=(size, size), num_frames=num_frames)
+        ims_and_transforms = [(seq.render(i), seq.transform(i))
+                                                    for i in range(num_frames)]
+        rect = stack.get_bounding_rect(ims_and_transforms)
+        def run():
+            stacked = stack.StackedImage(rect)
+            for im, M in ims_and_transforms:
+                stacked.add_image(im, M)
+            return stacked
+        t, _ = _time(run)
+        row = {'benchmark': 'stack', 'size': size, 'frames': num_frames,
+               'output_size': [int(rect[2]), int(rect[3])],
+               'time': t / num_frames}
+
+        # Stacking is only checked against the reference frame, so the output
+        # rect is that of the first frame.
+        ref_im = seq.render(0, noise=False, body=False).astype(numpy.float64)
+        ref_rect = stack.get_bounding_rect([(seq.size, seq.transform(0))])
+        stack_errors = []
+        for i in range(1, num_frames):
+            stacked = stack.StackedImage(ref_rect)
+            stacked.add_image(seq.render(i, noise=False, body=False),
+                              seq.transform(i))
+            covered = stacked.im > 0
+            stack_errors.append(float(numpy.mean(numpy.abs(
+                                    stacked.im[covered] - ref_im[covered]))))
+        row['stack_error'] = max(stack_errors)
+        rows.append(row)
+
+    return rows
+
+def bench_batched(lengths, num_stars=30, size=512):
+    """
+    Time `reg.fit_transforms` and `stack.get_bounding_rect` on long sequences.
+
+    Each frame's transformation is fitted to the true positions of its stars
+    in the reference frame and in the frame itself, so the fitted
+    transformations should match the true ones.
+
+    Returns:
+        A list of dicts, one per sequence length. Each has the time taken to
+        fit all of the transformations in one batch, and one at a time, the
+        greatest corner error of the batched fits, and the time taken to
+        compute the bounding rect of all of the frames.
+
+    """
+    rows = []
+    for length in lengths:
+        seq = SyntheticSequence(num_stars=num_stars, size=(size, size),
+                                num_frames=length)
+        points1 = seq._positions
+        transforms = numpy.array([seq.transform(i) for i in range(length)])
+        points2 = (numpy.einsum('bij,nj->bni', transforms[:, :2, :2],
+                                points1) + transforms[:, None, :2, 2])
+        points1 = numpy.repeat(points1[None], length, axis=0)
+
+        row = {'benchmark': 'batched', 'size': size, 'stars': num_stars,
+               'frames': length}
+        row['fit_time'], fitted = _time(
+                                lambda: reg.fit_transforms(points1, points2))
+        row['fit_loop_time'], _ = _time(
+                lambda: [reg._transformation_from_points(p1, p2)
+                            for p1, p2 in zip(points1, points2)])
+        row['corner_error'] = max(
+                _corner_error(numpy.matrix(M), seq.transform(i), seq.size)
+                for i, M in enumerate(fitted))
+        row['rect_time'], _ = _time(
+                lambda: stack.get_bounding_rect((seq.size, seq.transform(i))
+                                                for i in range(length)))
+        rows.append(row)
+
+    return rows
+
+def _check(rows):
+    """Return a list of descriptions of accuracy limits which are exceeded."""
+    failures = []
+    for row in rows:
+        desc = ", ".join("{}={}".format(k, row[k])
+                         for k in ('benchmark', 'size', 'stars', 'frames',
+                                   'method', 'matcher') if k in row)
+        if 'error' in row:
+            failures.append("{}: {}".format(desc, row['error']))
+        elif row.get('corner_error', 0) > MAX_CORNER_ERROR:
+            failures.append("{}: corner error {:.3f}px".format(
+                                                  desc, row['corner_error']))
+        elif row.get('stack_error', 0) > MAX_STACK_ERROR:
+            failures.append("{}: stack error {:.3f}".format(
+                                                   desc, row['stack_error']))
+        elif row.get('recall', 1) < MIN_RECALL:
+            failures.append("{}: recall {:.2f}".format(desc, row['recall']))
+        elif row.get('failed', 0) > 0:
+            failures.append("{}: {} frames failed to register".format(
+                                                          desc, row['failed']))
+
+    return failures
+
+def _print_rows(rows):
+    for row in rows:
+        print "  " + "  ".join(
+            "{}={}".format(k, "{:.4g}".format(v) if isinstance(v, float)
+                                                 else v)
+            for k, v in sorted(row.items()) if k != 'benchmark')
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+                description='Benchmark star extraction, registration and '
+                            'stacking on synthetic frames.')
+    parser.add_argument('--quick', '-q', action='store_const',
+                        const=True, default=False,
+                        help='Run a reduced set of benchmarks.')
+    parser.add_argument('--output', '-o', required=False,
+                        help='Write the results to this file as JSON.')
+    parser.add_argument('--check', action='store_const',
+                        const=True, default=False,
+                        help='Exit with a non-zero status if any result is '
+                             'less accurate than the limits in bench.py.')
+    parser.add_argument('--no-verify', action='store_const',
+                        const=True, default=False,
+                        help="Register without checking each match's "
+                             "support over all the stars (see "
+                             "reg.register_pair). Mirrored and chance "
+                             "matches are then expected in dense fields.")
+    args = parser.parse_args()
+
+    # Real LORRI frames are 1024px, and hold at most `stars.MAX_STARS` stars.
+    # A 256px frame with even `stars.MIN_STARS` stars is far denser than that,
+    # and mostly measures how extraction merges neighbouring stars, so frames
+    # of at least 512px are used.
+    if args.quick:
+        sizes, star_counts, lengths = [512], [15, 30], [10]
+    else:
+        sizes, star_counts, lengths = [512, 1024], [10, 20, 40], [10, 50]
+    verify = not args.no_verify
+
+    benchmarks = [
+        ("stars.extract", lambda: bench_extract(sizes, star_counts)),
+        ("reg.register_pair",
+            lambda: bench_register_pair(star_counts, verify=verify)),
+        ("reg.register_many",
+            lambda: bench_register_many(lengths, verify=verify)),
+        ("stack.StackedImage.add_image", lambda: bench_stack(sizes)),
+        ("reg.fit_transforms and stack.get_bounding_rect",
+         lambda: bench_batched([100 * l for l in lengths])),
+    ]
+
+    all_rows = []
+    for name, bench in benchmarks:
+        print name
+        rows = bench()
+        _print_rows(rows)
+        all_rows.extend(rows)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(all_rows, f, indent=2)
+
+    failures = _check(all_rows)
+    for failure in failures:
+        print "FAILED {}".format(failure)
+    if args.check and failures:
+        sys.exit(1)
@@ -28,6 +28,7 @@ Module for downloading and caching LORRI images.
 __all__ = (
     'update_metadata',
     'load_metadata',
+    'metadata_mtime',
     'check_images',
     'IMG_FORMAT',
     'MissingImage',
@@ -40,7 +41,8 @@ import json
 import os
 import re
 import time
-import urllib2
+
+import fetch
 
 _THUMBNAIL_URL_FORMAT = ("http://pluto.jhuapl.edu/soc/Pluto-Encounter/"
                          "index.php?page={}")
@@ -49,11 +51,20 @@ _TIMESTAMP_FORMAT = "%Y-%m-%d<br>%H:%M:%S %Z"
 _IMG_PATH = "data/images/input/"
 IMG_FORMAT = _IMG_PATH + "%Y-%m-%d_%H%M%S_%Z.jpg"
 _METADATA_FILE = _IMG_PATH + "metadata.json"
+_SYNC_FILE = _IMG_PATH + "metadata.sync.json"
 
-FETCH_SLEEP = 1.0   # Avoid spamming the server!
+# Avoid spamming the server! This is the maximum aggregate number of HTTP
+# requests per second, across all download threads.
+REQUESTS_PER_SECOND = 1.0
+DOWNLOAD_CONCURRENCY = 4
+SYNC_CONCURRENCY = 2  # Number of metadata pages fetched at a time.
 MAX_FETCHES = 1000  # Should never need more than this number of HTTP
-                    # requests.
-num_fetches = 0
+                    # requests for a single metadata update, or a single
+                    # batch of downloads.
+
+_fetcher = fetch.Fetcher(rate=REQUESTS_PER_SECOND,
+                         concurrency=DOWNLOAD_CONCURRENCY,
+                         max_requests=MAX_FETCHES)
 
 def _parse_line(line):
     l = []
@@ -77,37 +88,28 @@ def _parse_line(line):
 class _InvalidPageNum(Exception):
     pass
 
-def _urlopen(url):
-    global num_fetches
-    num_fetches += 1
-
-    assert num_fetches < MAX_FETCHES, ("Too many HTTP requests ({}) "
-                                             "attempted!".format(num_fetches))
-    f = urllib2.urlopen(url)
-    time.sleep(FETCH_SLEEP)
-
-    return f
-
 def _get_data_for_page(page_num):
     print "Fetching page {}".format(page_num)
-    f = _urlopen(_THUMBNAIL_URL_FORMAT.format(page_num))
+    page = _fetcher.fetch(_THUMBNAIL_URL_FORMAT.format(page_num))
 
-    for line in f.readlines():
+    for line in page.splitlines(True):
         if line.startswith("StatusArr.push"):
             return _parse_line(line)
 
     raise _InvalidPageNum
 
-def _metadata_gen():
-    page_num = 1
-    while True:
-        try:
-            for d in _get_data_for_page(page_num):
-                yield d
-        except _InvalidPageNum:
-            return
+def _get_page_or_none(page_num):
+    try:
+        return page_num, _get_data_for_page(page_num)
+    except _InvalidPageNum:
+        return page_num, None
 
-        page_num += 1
+def _write_json(path, obj):
+    """Write a JSON file, such that a crash never leaves a partial file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_path, path)
 
 class NoMetadataFile(Exception):
     pass
@@ -120,49 +122,116 @@ def load_metadata():
     with open(_METADATA_FILE, 'r') as f:
         return json.load(f)
 
-def update_metadata():
-    """Download any missing meta-data from the New Horizon's website."""
+def _merge_metadata(metadata, updates):
+    """Merge new records into the metadata, newest first."""
+    keys = set((d['timestamp'], d['url']) for d in metadata)
+    return sorted(metadata + [d for d in updates
+                                   if (d['timestamp'], d['url']) not in keys],
+                  key=lambda d: d['timestamp'], reverse=True)
 
-    try:
-        old_metadata = load_metadata()
-    except NoMetadataFile:
-        old_metadata = []
+def metadata_mtime():
+    """
+    Return the metadata file's modification time, or None if it's missing.
 
-    updates = []
-    for d in _metadata_gen():
-        if (len(old_metadata) > 0 and
-            d['timestamp'] == old_metadata[0]['timestamp']):
-            break
-        updates.append(d)
+    """
+    if not os.path.exists(_METADATA_FILE):
+        return None
+    return os.stat(_METADATA_FILE).st_mtime
 
-    print "Downloaded new metadata for {} files".format(len(updates))
+def update_metadata():
+    """
+    Download any missing meta-data from the New Horizon's website.
 
-    with open(_METADATA_FILE, 'w') as f:
-        json.dump(updates + old_metadata, f)
+    Pages are fetched `SYNC_CONCURRENCY` at a time, newest first, until the
+    newest previously known record is reached. New records are merged into
+    the metadata file after each batch of pages, and progress is checkpointed,
+    so an interrupted sync resumes where it left off. The metadata file is
+    only ever replaced atomically, and is left untouched if there are no new
+    records.
+
+    """
+    _fetcher.reset_request_count()
+    try:
+        metadata = load_metadata()
+    except NoMetadataFile:
+        metadata = []
+
+    # `anchor` is the timestamp of the newest record from before the sync
+    # started. Records are downloaded until it is reached.
+    if os.path.exists(_SYNC_FILE):
+        with open(_SYNC_FILE, 'r') as f:
+            checkpoint = json.load(f)
+        print "Resuming metadata sync from page {}".format(
+                                                      checkpoint['next_page'])
+    else:
+        checkpoint = {
+            'anchor': metadata[0]['timestamp'] if metadata else None,
+            'next_page': 1,
+        }
+
+    num_updates = 0
+    done = False
+    while not done:
+        page_nums = range(checkpoint['next_page'],
+                          checkpoint['next_page'] + SYNC_CONCURRENCY)
+        pages = sorted(_fetcher.map(_get_page_or_none, page_nums))
+
+        updates = []
+        for page_num, page in pages:
+            if page is None:
+                done = True
+                break
+            for d in page:
+                if d['timestamp'] == checkpoint['anchor']:
+                    done = True
+                    break
+                updates.append(d)
+            if done:
+                break
+
+        # The metadata file is only rewritten if it has changed, so that its
+        # modification time only moves when there are new records.
+        if updates:
+            metadata = _merge_metadata(metadata, updates)
+            num_updates += len(updates)
+            _write_json(_METADATA_FILE, metadata)
+
+        checkpoint['next_page'] = page_nums[-1] + 1
+        if not done:
+            _write_json(_SYNC_FILE, checkpoint)
+
+    if os.path.exists(_SYNC_FILE):
+        os.remove(_SYNC_FILE)
+
+    print "Downloaded new metadata for {} files".format(num_updates)
 
 def _download_image(d):
     print "Downloading {} to {}".format(d['url'], d["image_path"])
-    time.sleep(FETCH_SLEEP)
-    in_f = _urlopen(d['url'])
-    with open(d["image_path"], 'w') as out_f:
-        out_f.write(in_f.read())
+    _fetcher.fetch_to_file(d['url'], d["image_path"])
+    return d
 
 class MissingImage(Exception):
     pass
 
-def check_images(metadata, download_missing=False):
+def check_images(metadata, download_missing=False, volume=None):
     """
     Check images for the provided metadata have been downloaded.
 
     If the `download_missing` argument is False, `MissingImage` is raised for
-    any missing images.
+    any missing images. Otherwise missing images are downloaded, several at a
+    time, subject to `REQUESTS_PER_SECOND`. If a `volume.FrameVolume` is
+    given, any downloaded images are appended to it.
 
     """
-    for d in metadata:
-        if not os.path.exists(d["image_path"]):
-            if download_missing:
-                _download_image(d)
-            else:
-                raise MissingImage("Image {} has not been downloaded".format(
-                                                             d["image_path"]))
-
+    missing = [d for d in metadata if not os.path.exists(d["image_path"])]
+    if missing and not download_missing:
+        raise MissingImage("Image {} has not been downloaded".format(
+                                                     missing[0]["image_path"]))
+
+    _fetcher.reset_request_count()
+    for d in _fetcher.map(_download_image, missing):
+        if volume is not None:
+            try:
+                volume.append(d["timestamp"], d["image_path"])
+            except IOError as e:
+                print "Not packing {}: {}".format(d["image_path"], e)
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Persistent stores for data derived from the input images.
+
+"""
+
+__all__ = (
+    'StarCatalog',
+    'TransformStore',
+)
+
+import hashlib
+import json
+import os
+import time
+
+import numpy
+
+import frames
+import reg
+import stars
+
+_CATALOG_FILE = "data/images/input/stars.json"
+_TRANSFORMS_FILE = "data/images/input/transforms.json"
+
+def _extract_params(method):
+    """Return the parameters which affect the output of `stars.extract`."""
+    return {
+        'method': method,
+        'threshold_fraction': stars.THRESHOLD_FRACTION,
+        'threshold_bias': stars.THRESHOLD_BIAS,
+        'dilation_size': stars.DILATION_SIZE,
+        'min_stars': stars.MIN_STARS,
+        'max_stars': stars.MAX_STARS,
+        'fields': list(stars.Star._fields),
+    }
+
+def _register_params():
+    """
+    Return the parameters which affect the output of `reg.register_pair`,
+    other than the matcher and whether models are verified.
+
+    """
+    return {
+        'max_iters': reg.MAX_ITERS,
+        'num_stars_to_pair': reg.NUM_STARS_TO_PAIR,
+        'max_distance': reg.MAX_DISTANCE,
+        'min_inlier_fraction': reg.MIN_INLIER_FRACTION,
+        'hashing_seeds': reg.HASHING_SEEDS,
+    }
+
+def _stars_digest(star_list):
+    """Return a string which identifies a particular list of stars."""
+    positions = stars.as_star_set(star_list).positions.tolist()
+    return hashlib.sha1(json.dumps([[round(x, 3), round(y, 3)]
+                                           for x, y in positions])).hexdigest()
+
+def _write_json(path, obj):
+    """Write a JSON file, such that a crash never leaves a partial file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_path, path)
+
+class StarCatalog(object):
+    """
+    A persistent record of the stars extracted from each input image.
+
+    Entries are keyed on the image path, and are only considered valid if the
+    image's modification time and size, and the extraction parameters in
+    `stars` (including the extraction method and the fields of `stars.Star`),
+    are unchanged since the entry was recorded. Failed extractions are
+    recorded as well as successful ones, so that images which are known to be
+    unusable are not retried.
+
+    """
+
+    def __init__(self, path=_CATALOG_FILE, method='contours'):
+        self._path = path
+        self._method = method
+        self._params = _extract_params(method)
+        self._dirty = False
+        self._save_time = time.time()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+        else:
+            self._entries = {}
+
+    def lookup(self, image_path):
+        """
+        Return the stars previously extracted from an image.
+
+        `KeyError` is raised if there is no valid entry for the image, and
+        `stars.ExtractFailed` is raised if the extraction previously failed.
+
+        """
+        entry = self._entries[image_path]
+        if (entry['file_id'] != frames.file_id(image_path) or
+            entry['params'] != self._params):
+            raise KeyError(image_path)
+
+        if entry['error'] is not None:
+            raise stars.ExtractFailed(entry['error'])
+        return stars.StarSet.from_rows(entry['stars'])
+
+    def record(self, image_path, star_list=None, error=None):
+        """
+        Record the result of extracting stars from an image.
+
+        Either `star_list` should be the extracted stars, or `error` should be
+        the `stars.ExtractFailed` exception raised when attempting extraction.
+
+        """
+        self._entries[image_path] = {
+            'file_id': frames.file_id(image_path),
+            'params': self._params,
+            'stars': (stars.as_star_set(star_list).tolist()
+                                        if star_list is not None else None),
+            'error': str(error) if error is not None else None,
+        }
+        self._dirty = True
+
+    def extract(self, image_path, im):
+        """
+        Return the stars in an image, extracting them only if necessary.
+
+        Arguments:
+            image_path: Path of the image, used to key the catalog.
+            im: The decoded image, as passed to `stars.extract`.
+
+        Returns:
+            A `stars.StarSet`. `stars.ExtractFailed` is raised if extraction
+            fails (or previously failed).
+
+        """
+        try:
+            return self.lookup(image_path)
+        except KeyError:
+            pass
+
+        try:
+            star_list = stars.extract(im, method=self._method)
+        except stars.ExtractFailed as e:
+            self.record(image_path, error=e)
+            raise
+        self.record(image_path, star_list=star_list)
+
+        return star_list
+
+    def save(self, min_interval=0.):
+        """
+        Write any new entries to disk.
+
+        The whole file is rewritten, so if the file was written less than
+        `min_interval` seconds ago, new entries are left for a later call.
+
+        """
+        if self._dirty and time.time() - self._save_time >= min_interval:
+            _write_json(self._path, self._entries)
+            self._dirty = False
+            self._save_time = time.time()
+
+class TransformStore(object):
+    """
+    A persistent record of the results of `reg.register_many`.
+
+    Results are keyed on the reference image's stars, and on the stars of the
+    registered image, so an entry remains valid for as long as the star
+    catalog entries for both images are unchanged. An instance can be passed
+    as the `store` argument of `reg.register_many`, so that extending a
+    sequence only registers the new images.
+
+    Entries are only considered valid if the registration parameters in `reg`
+    are unchanged since the entry was recorded. Successful registrations are
+    valid irrespective of which images were tried, and which matcher was
+    used, unless verification is requested and the registration was not
+    verified. A failed registration is only reused if the same set of images
+    would be tried again with the same matcher and verification setting.
+
+    """
+
+    def __init__(self, path=_TRANSFORMS_FILE):
+        self._path = path
+        self._params = _register_params()
+        self._dirty = False
+        self._save_time = time.time()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+        else:
+            self._entries = {}
+
+    def lookup(self, candidates, star_list, matcher='ransac', verify=False):
+        """
+        Return the stored result of registering an image, or None.
+
+        Arguments:
+            candidates: Sequence of `(idx, stars, M)` tuples of images that the
+                image would be registered against. The first is the reference
+                image.
+            star_list: Stars of the image being registered.
+            matcher, verify: Arguments that the image would be registered
+                with. See `reg.register_pair`.
+
+        """
+        digests = [_stars_digest(c[1]) for c in candidates]
+        entry = self._entries.get(digests[0], {}).get(
+                                                     _stars_digest(star_list))
+        if entry is None or entry.get('params') != self._params:
+            return None
+
+        if entry['transform'] is not None:
+            if verify and not entry.get('verify'):
+                return None
+            idxs = dict(zip(digests, (c[0] for c in candidates)))
+            return reg.RegistrationResult(
+                               exception=None,
+                               transform=numpy.matrix(entry['transform']),
+                               reference_idx=idxs.get(entry['reference']))
+        elif (entry['tried'] == digests and entry['matcher'] == matcher and
+              entry.get('verify', False) == verify):
+            return reg.RegistrationResult(exception=reg.RegistrationFailed(),
+                                          transform=None)
+
+        return None
+
+    def record(self, candidates, star_list, reg_result, matcher='ransac',
+               verify=False):
+        """
+        Record the result of registering an image.
+
+        Arguments are as for `lookup`, with `reg_result` being the
+        `reg.RegistrationResult` of the registration.
+
+        """
+        digests = [_stars_digest(c[1]) for c in candidates]
+        if reg_result.exception is None:
+            idx_to_digest = dict(zip((c[0] for c in candidates), digests))
+            entry = {
+                'transform': reg_result.transform.tolist(),
+                'reference': idx_to_digest[reg_result.reference_idx],
+                'tried': None,
+            }
+        else:
+            entry = {'transform': None, 'reference': None, 'tried': digests}
+        entry['params'] = self._params
+        entry['matcher'] = matcher
+        entry['verify'] = verify
+
+        self._entries.setdefault(digests[0], {})[
+                                            _stars_digest(star_list)] = entry
+        self._dirty = True
+
+    def save(self, min_interval=0.):
+        """
+        Write any new entries to disk.
+
+        The whole file is rewritten, so if the file was written less than
+        `min_interval` seconds ago, new entries are left for a later call.
+
+        """
+        if self._dirty and time.time() - self._save_time >= min_interval:
+            _write_json(self._path, self._entries)
+            self._dirty = False
+            self._save_time = time.time()
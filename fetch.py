@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+HTTP fetching with connection reuse, rate limiting and retries.
+
+"""
+
+__all__ = (
+    'Fetcher',
+    'FetchFailed',
+    'TokenBucket',
+)
+
+import email.utils
+import httplib
+import os
+import socket
+import threading
+import time
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+# Maximum number of redirects followed for a single request.
+_MAX_REDIRECTS = 5
+
+# Longest delay requested by a Retry-After header which is honoured, in
+# seconds. Longer delays are shortened to this.
+_MAX_RETRY_AFTER = 300.
+
+class FetchFailed(Exception):
+    pass
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket rate limiter.
+
+    Tokens are added at a fixed rate up to a maximum of `burst`. Each call to
+    `acquire` consumes a token, blocking until one is available.
+
+    """
+
+    def __init__(self, rate, burst=1):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._last) * self._rate)
+            self._last = now
+
+            # Take the token now, even if it's not yet available, so that
+            # concurrent callers queue up behind this one.
+            self._tokens -= 1.
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+def _retry_after(headers):
+    """
+    Return the delay in seconds requested by a response's Retry-After header,
+    or 0 if there is no valid header.
+
+    """
+    value = headers.get('retry-after')
+    if value is None:
+        return 0.
+    try:
+        delay = float(value)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return 0.
+        delay = email.utils.mktime_tz(date) - time.time()
+
+    return min(max(delay, 0.), _MAX_RETRY_AFTER)
+
+class Fetcher(object):
+    """
+    Fetches URLs over persistent HTTP connections.
+
+    Each thread keeps one keep-alive connection per host. `map` uses a pool
+    of threads which lasts as long as the Fetcher, so connections are reused
+    across calls. All requests, from any thread, share a single
+    `TokenBucket`, so the request rate to the server is bounded irrespective
+    of the number of threads. Failed requests (connection errors, 5xx
+    responses and 429 Too Many Requests responses) are retried with
+    exponential backoff, waiting at least as long as any Retry-After header
+    asks.
+
+    """
+
+    def __init__(self, rate, concurrency=1, retries=3, backoff=2.0,
+                 max_requests=None):
+        """
+        Initialize a new Fetcher.
+
+        Arguments:
+            rate: Maximum aggregate number of requests per second.
+            concurrency: Number of threads used by `map`.
+            retries: Number of times a failed request is retried.
+            backoff: Delay before the first retry, in seconds. The delay
+                doubles with each subsequent retry.
+            max_requests: If not None, an `AssertionError` is raised if more
+                than this many requests are attempted since the Fetcher was
+                created, or since `reset_request_count` was last called.
+
+        """
+        self._bucket = TokenBucket(rate)
+        self._concurrency = concurrency
+        self._retries = retries
+        self._backoff = backoff
+        self._max_requests = max_requests
+        self._num_requests = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+
+    def reset_request_count(self):
+        """Start a new budget of `max_requests` requests."""
+        with self._lock:
+            self._num_requests = 0
+
+    def _connection(self, scheme, netloc):
+        conns = self._local.__dict__.setdefault('conns', {})
+        if (scheme, netloc) not in conns:
+            conn_class = (httplib.HTTPSConnection if scheme == 'https' else
+                          httplib.HTTPConnection)
+            conns[scheme, netloc] = conn_class(netloc, timeout=60)
+        return conns[scheme, netloc]
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self._local.__dict__.get('conns', {}).pop((scheme, netloc),
+                                                          None)
+        if conn is not None:
+            conn.close()
+
+    def _request(self, url):
+        """
+        Make a single GET request, returning `(status, headers, body)`.
+
+        `headers` is a dict, keyed by lower case header names.
+
+        """
+        with self._lock:
+            self._num_requests += 1
+            assert (self._max_requests is None or
+                    self._num_requests < self._max_requests), (
+                      "Too many HTTP requests ({}) attempted!".format(
+                                                          self._num_requests))
+        self._bucket.acquire()
+
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                    ''))
+        conn = self._connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException):
+            self._drop_connection(parts.scheme, parts.netloc)
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            self._drop_connection(parts.scheme, parts.netloc)
+
+        return response.status, dict(response.getheaders()), body
+
+    def fetch(self, url):
+        """Return the body of the resource at a URL."""
+        for redirect in range(_MAX_REDIRECTS + 1):
+            delay = 0.
+            for attempt in range(self._retries + 1):
+                if attempt > 0:
+                    time.sleep(delay)
+                delay = self._backoff * 2 ** attempt
+                try:
+                    status, headers, body = self._request(url)
+                except (socket.error, httplib.HTTPException) as e:
+                    error = FetchFailed("{}: {}".format(url, e))
+                    continue
+                if status < 500 and status != 429:
+                    break
+                delay = max(delay, _retry_after(headers))
+                error = FetchFailed("{}: HTTP status {}".format(url, status))
+            else:
+                raise error
+
+            location = headers.get('location')
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status != 200:
+                raise FetchFailed("{}: HTTP status {}".format(url, status))
+            return body
+
+        raise FetchFailed("{}: Too many redirects".format(url))
+
+    def fetch_to_file(self, url, path):
+        """
+        Fetch a URL and write it to a file.
+
+        The data is written to a temporary file which is then renamed, so the
+        destination is never left partially written.
+
+        """
+        body = self.fetch(url)
+        tmp_path = path + ".part"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.rename(tmp_path, path)
+
+    def map(self, func, items):
+        """
+        Apply a function to each item, using up to `concurrency` threads.
+
+        Results are yielded in completion order. The threads are reused by
+        subsequent calls, along with their connections. `func` must not
+        itself call `map`.
+
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self._concurrency)
+        for result in self._pool.imap_unordered(func, items):
+            yield result
+
+    def close(self):
+        """
+        Stop the threads used by `map`, and close the calling thread's
+        connections. The other threads' connections are closed as the threads
+        exit.
+
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for conn in self._local.__dict__.pop('conns', {}).values():
+            conn.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Routines for loading input frames.
+
+"""
+
+__all__ = (
+    'compute_stats',
+    'estimate_mean',
+    'file_id',
+    'FrameCache',
+    'image_shape',
+    'load_image',
+    'MEAN_ESTIMATE_MARGIN',
+)
+
+import collections
+import os
+import struct
+
+import cv2
+import numpy
+
+# `estimate_mean` decodes JPEGs at 1/8 scale, which biases the mean upwards by
+# up to about half a level. A frame should only be judged too bright on its
+# estimated mean if the estimate exceeds the limit by this margin.
+MEAN_ESTIMATE_MARGIN = 1.0
+
+# JPEG start-of-frame markers, which are followed by the image dimensions.
+_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+def _jpeg_shape(f):
+    """Return the dimensions in a JPEG file's header, or None."""
+    if f.read(2) != '\xff\xd8':
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0] != '\xff':
+            return None
+        if ord(marker[1]) in _SOF_MARKERS:
+            _, _, height, width = struct.unpack('>HBHH', f.read(7))
+            return height, width
+        length, = struct.unpack('>H', f.read(2))
+        f.seek(length - 2, 1)
+
+def file_id(path):
+    """Return a cheap identifier which changes when a file is modified."""
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+def load_image(path, volume=None):
+    """
+    Return the grayscale image at a given path.
+
+    If a `volume.FrameVolume` is given and holds the frame, a memory-mapped
+    view of it is returned instead of decoding the image.
+
+    """
+    if volume is not None and volume.has_path(path):
+        return volume.load_path(path)
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+def compute_stats(im):
+    """
+    Return statistics of a decoded image.
+
+    Returns:
+        A dict with the image's 'mean' value, and its 'hist', a list of the
+        number of pixels with each of the 256 possible values. The histogram
+        can be passed to `stars.extract` to avoid recomputing it.
+
+    """
+    hist = cv2.calcHist([im], [0], None, [256], [0, 256])[:, 0].astype(int)
+    return {
+        'mean': float(numpy.dot(hist, numpy.arange(256))) / im.size,
+        'hist': hist.tolist(),
+    }
+
+def estimate_mean(path, volume=None):
+    """
+    Estimate the mean value of an image, without fully decoding it.
+
+    JPEGs are decoded at reduced resolution, which is several times faster
+    than a full decode. See `MEAN_ESTIMATE_MARGIN` for the accuracy of the
+    result.
+
+    Returns:
+        The estimated mean, or None if the image is in the volume (in which
+        case it can be read without decoding), or can't be decoded at reduced
+        resolution.
+
+    """
+    flag = getattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_8', None)
+    if flag is None or (volume is not None and volume.has_path(path)):
+        return None
+
+    im = cv2.imread(path, flag)
+    if im is None:
+        return None
+    return float(numpy.mean(im))
+
+def image_shape(path, volume=None):
+    """
+    Return the `(height, width)` of an image without decoding it, if possible.
+
+    JPEG dimensions are read from the file's header, or from a
+    `volume.FrameVolume` if one is given. Other images are decoded.
+
+    """
+    if volume is not None and volume.has_path(path):
+        return volume.load_path(path).shape
+
+    with open(path, 'rb') as f:
+        try:
+            shape = _jpeg_shape(f)
+        except struct.error:
+            shape = None
+
+    if shape is None:
+        shape = cv2.imread(path, cv2.IMREAD_GRAYSCALE).shape
+    return shape
+
+class FrameCache(object):
+    """
+    A least-recently-used cache of decoded grayscale frames.
+
+    The cache is bounded by the total size of the frames it holds, so memory
+    use does not grow with the number of frames loaded.
+
+    """
+
+    def __init__(self, max_bytes, volume=None):
+        """
+        Initialize a new FrameCache.
+
+        Arguments:
+            max_bytes: Maximum total size of the cached frames. The most
+                recently loaded frame is always returned, even if it is larger
+                than this.
+            volume: Optional `volume.FrameVolume`. Frames held by the volume
+                are returned as memory-mapped views, and are not counted
+                against `max_bytes`.
+
+        """
+        self._max_bytes = max_bytes
+        self._volume = volume
+        self._frames = collections.OrderedDict()
+        self._num_bytes = 0
+        self.peak_bytes = 0
+
+    def load(self, path):
+        """Return the decoded image at a given path."""
+        if self._volume is not None and self._volume.has_path(path):
+            return self._volume.load_path(path)
+
+        if path in self._frames:
+            im = self._frames.pop(path)
+        else:
+            im = load_image(path)
+            self._num_bytes += im.nbytes
+            self.peak_bytes = max(self.peak_bytes, self._num_bytes)
+        self._frames[path] = im
+
+        while self._num_bytes > self._max_bytes and len(self._frames) > 1:
+            _, evicted = self._frames.popitem(last=False)
+            self._num_bytes -= evicted.nbytes
+
+        return im
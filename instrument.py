@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Recording of timings and counters, for performance analysis.
+
+"""
+
+__all__ = (
+    'NullReport',
+    'Report',
+)
+
+import collections
+import contextlib
+import csv
+import json
+import timeit
+
+class Report(object):
+    """
+    Wall times per stage and per frame, and counters, from a single run.
+
+    Stages are timed with the `stage` context manager:
+
+        report = Report()
+        with report.stage('extract'):
+            ...
+        report.frame(im_id, extract=0.01, stars=23)
+        report.count('too_bright')
+        report.save('report.json')
+
+    Each call to `frame` adds fields to the record for that frame. Frames are
+    kept in the order they were first recorded.
+
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.frames = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager which adds its wall time to a stage's total."""
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0.) +
+                                 timeit.default_timer() - start)
+
+    def frame(self, frame_id, **fields):
+        """Record fields for a frame."""
+        self.frames.setdefault(frame_id, collections.OrderedDict()).update(
+                                                                        fields)
+
+    def count(self, name, n=1):
+        """Add `n` to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def save(self, path):
+        """
+        Write the report to a file.
+
+        If `path` ends in `.csv`, the report is written as CSV with one
+        `(kind, name, field, value)` row per value, where `kind` is one of
+        'stage', 'counter' or 'frame'. Otherwise it is written as JSON.
+
+        """
+        if path.endswith('.csv'):
+            with open(path, 'wb') as f:
+                w = csv.writer(f)
+                w.writerow(('kind', 'name', 'field', 'value'))
+                for name, t in self.stages.items():
+                    w.writerow(('stage', name, 'time', t))
+                for name, n in self.counters.items():
+                    w.writerow(('counter', name, 'count', n))
+                for frame_id, fields in self.frames.items():
+                    for field, value in fields.items():
+                        w.writerow(('frame', frame_id, field, value))
+        else:
+            with open(path, 'w') as f:
+                json.dump({'stages': self.stages,
+                           'counters': self.counters,
+                           'frames': self.frames}, f, indent=2)
+
+class _NullContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_CONTEXT = _NullContext()
+
+class NullReport(object):
+    """
+    A `Report` which discards everything, used when reporting is disabled.
+
+    """
+
+    def stage(self, name):
+        return _NULL_CONTEXT
+
+    def frame(self, frame_id, **fields):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def save(self, path):
+        pass
@@ -21,30 +21,46 @@
 
 import argparse
 import calendar
-from collections import OrderedDict
+from collections import deque, OrderedDict
+import itertools
+import multiprocessing
+import os
 import re
+import resource
 import time
 
-import cv2
-import numpy
-
+import anim
 import cache
+import catalog
+import fetch
+import frames
+import instrument
+import metadb
 import reg
 import stack
 import stars
+import volume
+import writer
 
 IN_FORMAT = cache.IMG_FORMAT
-OUT_FORMAT = "data/images/stacked/%Y-%m-%d_%H%M%S_%Z.png"
+OUT_FORMAT = "data/images/stacked/%Y-%m-%d_%H%M%S_%Z"
 ID_FORMAT = "%Y-%m-%d_%H%M%S_%Z"
 
 EXPOSURE_FILTER = r'1[05]0 msec'
 
 MAX_BRIGHTNESS = 50.
 
+# Default bound on the memory used to cache decoded frames, in megabytes.
+MAX_MEMORY = 256
+
 # Frames that are less than this number of seconds apart will be stacked into
 # the same output image.
 MIN_FRAME_INTERVAL = 60 * 60 * 4
 
+# In watch mode, the star catalog and transform store are rewritten at most
+# this often, in seconds.
+CACHE_SAVE_INTERVAL = 5 * 60
+
 def parse_time(s):
     """Parse a user provided time into a number of seconds since the epoch."""
     t = None
@@ -67,6 +83,112 @@ def parse_time(s):
             return calendar.timegm(t)
     raise Exception("Invalid date/time {}".format(s))
 
+def extract_frame(task):
+    """
+    Check an image's brightness, and extract its stars.
+
+    This is run in worker processes when `--jobs` is greater than one.
+
+    Frame statistics records are dicts with the image's 'file_id' (see
+    `frames.file_id`), and either its 'mean' and 'hist' (see
+    `frames.compute_stats`), or just a 'mean_estimate' (see
+    `frames.estimate_mean`) if the image was found to be too bright from the
+    estimate alone. The image is only fully decoded if its brightness can't be
+    determined from its record, or a reduced resolution decode, and its stars
+    are not already known.
+
+    Arguments:
+        task: A `(image_path, max_brightness, method, cached, stats)` tuple. If
+            `cached` is not None it is a `(star_list, error)` pair previously
+            recorded in the star catalog, and extraction is skipped. `stats`
+            is the frame statistics record previously returned for the image,
+            or None.
+
+    Returns:
+        A `(too_bright, star_list, error, timings, stats)` tuple, where `error`
+        is the `stars.ExtractFailed` raised by extraction, if any, `timings`
+        is a dict of the time taken by each step, in seconds, and `stats` is a
+        new frame statistics record for the image, or None if the record
+        passed in is still valid.
+
+    """
+    image_path, max_brightness, method, cached, stats = task
+    timings = {}
+    new_stats = None
+    current_id = frames.file_id(image_path)
+    if stats is None or stats['file_id'] != current_id:
+        stats = new_stats = {'file_id': current_id}
+
+    start = time.time()
+    too_bright = None
+    if 'mean' in stats:
+        too_bright = stats['mean'] > max_brightness
+    else:
+        estimate = stats.get('mean_estimate')
+        if estimate is None:
+            estimate = frames.estimate_mean(image_path, frame_volume)
+        if (estimate is not None and
+            estimate > max_brightness + frames.MEAN_ESTIMATE_MARGIN):
+            too_bright = True
+            if 'mean_estimate' not in stats:
+                stats = new_stats = {'file_id': current_id,
+                                     'mean_estimate': estimate}
+    timings['brightness'] = time.time() - start
+    if too_bright:
+        return True, None, None, timings, new_stats
+    if too_bright is not None and cached is not None:
+        return (False,) + cached + (timings, new_stats)
+
+    start = time.time()
+    im = frames.load_image(image_path, frame_volume)
+    timings['load'] = time.time() - start
+
+    if 'mean' not in stats:
+        start = time.time()
+        stats = new_stats = dict(frames.compute_stats(im), file_id=current_id)
+        timings['brightness'] += time.time() - start
+        if stats['mean'] > max_brightness:
+            return True, None, None, timings, new_stats
+    if cached is not None:
+        return (False,) + cached + (timings, new_stats)
+
+    start = time.time()
+    try:
+        star_list = stars.extract(im, method=method, hist=stats['hist'])
+        error = None
+    except stars.ExtractFailed as e:
+        star_list, error = None, e
+    timings['extract'] = time.time() - start
+
+    return False, star_list, error, timings, new_stats
+
+def render_group(task):
+    """
+    Stack a group of images.
+
+    This is run in worker processes when `--jobs` is greater than one.
+
+    Arguments:
+        task: A `(rect, paths_and_transforms, black_cutoff)` tuple. See
+            `stack.StackedImage` for the meaning of `rect` and the transforms.
+
+    Returns:
+        The stacked image, and the time taken to stack it in seconds.
+
+    """
+    rect, paths_and_transforms, black_cutoff = task
+
+    start = time.time()
+    stacked = stack.StackedImage(rect)
+    for image_path, M in paths_and_transforms:
+        stacked.add_image(frame_cache.load(image_path), M)
+
+    im = stacked.im
+    if black_cutoff:
+        writer.apply_black_cutoff(im, black_cutoff)
+
+    return im, time.time() - start
+
 def parse_rect(s):
     out = tuple(map(int, s.split(',')))
     if len(out) != 4:
@@ -102,72 +224,501 @@ parser.add_argument('--black-cutoff', '-k', type=int, required=False,
                          'this level will be rounded to 0. This is to remove '
                          'invisible background noise and thereby aid GIF '
                          'compression')
+parser.add_argument('--no-star-cache', action='store_const',
+                    const=True, default=False,
+                    help="Don't read or write the cache of stars extracted "
+                         "from each image.")
+parser.add_argument('--no-transform-cache', action='store_const',
+                    const=True, default=False,
+                    help="Don't read or write the cache of registration "
+                         "results, and instead register every image.")
+parser.add_argument('--jobs', '-j', type=int, default=1,
+                    help='Number of processes to use for loading images, '
+                         'extracting stars, registering images and stacking.')
+parser.add_argument('--extract-method', choices=stars.METHODS,
+                    default='contours',
+                    help="Star extraction method. 'components' is faster, but "
+                         "requires OpenCV 3 or later.")
+parser.add_argument('--matcher', choices=reg.MATCHERS, default='ransac',
+                    help='Method used to find corresponding stars when '
+                         'registering images.')
+parser.add_argument('--verify-matches', action='store_const',
+                    const=True, default=False,
+                    help='Only accept a registration if it maps a reasonable '
+                         'fraction of all the stars onto stars. Slower, but '
+                         'rejects mirrored and chance matches in dense star '
+                         'fields.')
+parser.add_argument('--max-memory', '-m', type=float, default=MAX_MEMORY,
+                    help='Maximum size of the cache of decoded frames, in '
+                         'megabytes.')
+parser.add_argument('--pack-volume', action='store_const',
+                    const=True, default=False,
+                    help='Decode any selected images which are not already in '
+                         'the frame volume, and append them to it. Frames in '
+                         'the volume are read without decoding.')
+parser.add_argument('--output-format', choices=writer.FORMATS,
+                    default='png',
+                    help='Format of the stacked images. PGM is much faster to '
+                         'write than PNG, but is uncompressed.')
+parser.add_argument('--png-compression', type=int, default=3,
+                    choices=range(10),
+                    help='PNG compression level, from 0 (fastest) to 9 '
+                         '(smallest).')
+parser.add_argument('--animation', '-a', required=False,
+                    help='Stream the stacked images into an animation at this '
+                         'path, instead of writing them to '
+                         'data/images/stacked/. A .gif extension gives an '
+                         'animated GIF, whereas other extensions (eg. .avi) '
+                         'give a video.')
+parser.add_argument('--frame-delay', type=int, default=5,
+                    help='Delay between animation frames, in hundredths of a '
+                         'second.')
+parser.add_argument('--delta-frames', action='store_const',
+                    const=True, default=False,
+                    help='Only encode the changed region of each GIF frame.')
+parser.add_argument('--keep-frames', action='store_const',
+                    const=True, default=False,
+                    help='Write the stacked images to data/images/stacked/ '
+                         'even if --animation is given.')
+parser.add_argument('--report', '-r', required=False,
+                    help='Write timings for each stage and each frame, along '
+                         'with registration statistics, to this file. The '
+                         'report is written as CSV if the path ends in .csv, '
+                         'or JSON otherwise.')
+parser.add_argument('--watch', '-w', type=float, required=False,
+                    help='After processing the selected images, keep running '
+                         'and poll for new images every this many seconds. '
+                         'New images are registered and only the affected '
+                         'output images are re-rendered. Images are '
+                         'registered one at a time in this mode.')
+parser.add_argument('--tile-size', type=int, required=False,
+                    help='Stack each output image in square tiles of this '
+                         'size. Each input image is only warped into the '
+                         'tiles it overlaps, and tiles are stacked in '
+                         'parallel when --jobs is greater than one.')
+parser.add_argument('--memmap-canvas', action='store_const',
+                    const=True, default=False,
+                    help='Hold each output image in a memory-mapped '
+                         'temporary file, rather than in memory, so that '
+                         'large uncropped outputs can be produced. Implies '
+                         '--tile-size {}.'.format(stack.TILE_SIZE))
+parser.add_argument('--memmap-dir', required=False,
+                    help='Directory in which to create the --memmap-canvas '
+                         'temporary files. Defaults to the directory of the '
+                         'stacked images, since the system temporary '
+                         'directory may itself be held in memory. Implies '
+                         '--memmap-canvas.')
 args = parser.parse_args()
+if args.black_cutoff is not None and not 0 <= args.black_cutoff <= 255:
+    parser.error("--black-cutoff must be between 0 and 255")
+if args.memmap_dir is not None:
+    args.memmap_canvas = True
+elif args.memmap_canvas:
+    args.memmap_dir = os.path.dirname(OUT_FORMAT)
+if args.memmap_canvas and args.tile_size is None:
+    args.tile_size = stack.TILE_SIZE
+if args.watch is not None and args.animation:
+    parser.error("--animation can't be used with --watch")
+
+report = instrument.Report() if args.report else instrument.NullReport()
 
 # Obtain metadata for the requested images, updating the metadata and
 # downloading new images if requested by the user.
-if args.update_metadata:
-    cache.update_metadata()
+with report.stage('metadata'):
+    if args.update_metadata:
+        cache.update_metadata()
 
-metadata = [d for d in cache.load_metadata() if
-                vars(args)['from'] <= d["timestamp"] <= args.to and
-                re.match(args.exposure, d["exposure"])]
+    metadata_db = metadb.MetadataDB()
+    if metadata_db.sync_from_json():
+        print "Imported metadata into the metadata index"
+    metadata = metadata_db.query(vars(args)['from'], args.to,
+                                 args.exposure.pattern)
+    if not metadata and cache.metadata_mtime() is None:
+        raise cache.NoMetadataFile("Try running with -u?")
+
+frame_volume = volume.open_volume()
+if args.pack_volume and frame_volume is None:
+    frame_volume = volume.FrameVolume()
 
 print "Checking cache for {} images".format(len(metadata))
-cache.check_images(metadata, download_missing=args.download_missing)
+with report.stage('check_images'):
+    cache.check_images(metadata, download_missing=args.download_missing,
+                       volume=frame_volume)
+
+if args.pack_volume:
+    print "Packing images into the frame volume"
+    with report.stage('pack_volume'):
+        print "Appended {} frames to the frame volume".format(
+                                                frame_volume.update(metadata))
 
-print "Loading images"
 def metadata_to_id(d):
     return time.strftime(ID_FORMAT, time.gmtime(d["timestamp"]))
-ims = OrderedDict((metadata_to_id(d),
-                   cv2.imread(d["image_path"], cv2.IMREAD_GRAYSCALE))
-                      for d in sorted(metadata, key=lambda d: d['timestamp']))
-times = OrderedDict((metadata_to_id(d), d["timestamp"]) for d in metadata)
-
-print "Filtering images which are too bright"
-filtered_ims = OrderedDict((im_id, im) for im_id, im in ims.items()
-                                if numpy.mean(im) <= args.max_brightness)
-
-print "Extracting stars from {} / {} images".format(len(filtered_ims),
-                                                    len(ims))
-im_stars = OrderedDict()
-for im_id, im in filtered_ims.items():
+times = OrderedDict()
+paths = OrderedDict()
+
+star_catalog = catalog.StarCatalog(method=args.extract_method)
+def catalog_entry(image_path):
+    if args.no_star_cache:
+        return None
     try:
-        im_stars[im_id] = list(stars.extract(im))
+        return star_catalog.lookup(image_path), None
+    except KeyError:
+        return None
     except stars.ExtractFailed as e:
-        print "Failed to extract stars for {}: {}".format(im_id, e)
+        return None, e
+
+def extract_stars(metadata):
+    """
+    Extract stars from the images for a list of metadata records.
+
+    Returns:
+        An `OrderedDict` mapping image IDs to stars, for images which are not
+        too bright, and whose stars were successfully extracted.
+
+    """
+    metadata = OrderedDict((metadata_to_id(d), d) for d in metadata).values()
+    new_paths = OrderedDict((metadata_to_id(d), d["image_path"])
+                                                            for d in metadata)
+    times.update((metadata_to_id(d), d["timestamp"]) for d in metadata)
+    paths.update(new_paths)
+
+    print "Extracting stars from {} images".format(len(new_paths))
+    frame_stats = metadata_db.get_fields((d["timestamp"] for d in metadata),
+                                         'frame_stats')
+    tasks = [(d["image_path"], args.max_brightness, args.extract_method,
+              catalog_entry(d["image_path"]), frame_stats.get(d["timestamp"]))
+             for d in metadata]
 
-print "Registering {} / {} images".format(len(im_stars), len(ims))
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    imap = pool.imap if pool is not None else itertools.imap
+    im_stars = OrderedDict()
+    num_too_bright = 0
+    with report.stage('extract'):
+        for (im_id, image_path), d, task, (too_bright, star_list, error,
+                                           timings, stats) in itertools.izip(
+                                   new_paths.items(), metadata, tasks,
+                                   imap(extract_frame, tasks)):
+            report.frame(im_id, **timings)
+            if 'load' in timings:
+                report.count('loaded')
+            if stats is not None:
+                metadata_db.set_field(d["timestamp"], 'frame_stats', stats)
+            if too_bright:
+                report.count('too_bright')
+                num_too_bright += 1
+                continue
+            if task[3] is not None:
+                report.count('extract_cached')
+            elif not args.no_star_cache:
+                star_catalog.record(image_path, star_list=star_list,
+                                    error=error)
+            if error is not None:
+                report.count('extract_failed')
+                print "Failed to extract stars for {}: {}".format(im_id, error)
+            else:
+                report.frame(im_id, stars=len(star_list))
+                im_stars[im_id] = star_list
+        if pool is not None:
+            pool.close()
+    metadata_db.commit()
+    print "Discarded {} / {} images which are too bright".format(
+                                                num_too_bright, len(new_paths))
+
+    return im_stars
+
+transform_store = (catalog.TransformStore()
+                        if not args.no_transform_cache else None)
 transforms = OrderedDict()
-for im_id, reg_result in zip(im_stars.keys(),
-                             reg.register_many(im_stars.values())):
-    try:
-        M = reg_result.result()
-    except reg.RegistrationFailed as e:
-        print "Failed to register {}: {}".format(im_id, e)
+
+# The first images are registered in one (possibly parallel) `register_many`
+# call. In watch mode, images which arrive later are fed through
+# `pending_stars` to a single lazy `register_many` call, which continues from
+# `registered`: the reference image and the most recently registered images.
+# They are therefore registered against the same images as in a batch run.
+# `register_ids` maps `register_many` indices to image IDs.
+registered = []
+register_ids = {}
+pending_stars = deque()
+def iter_pending_stars():
+    while True:
+        yield pending_stars.popleft()
+reg_results = None
+next_idx = 0
+
+def register_frames(im_stars):
+    """Register images, adding successfully registered ones to `transforms`."""
+    global reg_results, next_idx
+    if not registered:
+        results = reg.register_many(im_stars.values(), store=transform_store,
+                                    matcher=args.matcher, jobs=args.jobs,
+                                    verify=args.verify_matches)
     else:
-        transforms[im_id] = M
+        if reg_results is None:
+            reg_results = reg.register_many(iter_pending_stars(),
+                                            store=transform_store,
+                                            matcher=args.matcher,
+                                            verify=args.verify_matches,
+                                            registered=registered)
+            next_idx = registered[-1][0] + 1
+        pending_stars.extend(im_stars.values())
+        results = reg_results
 
-print "Stacking {} / {} images".format(len(transforms), len(ims))
-rect = stack.get_bounding_rect((ims[im_id], M)
+    print "Registering {} / {} images".format(len(im_stars), len(paths))
+    with report.stage('register'):
+        for im_id, star_list in im_stars.items():
+            idx = next_idx
+            next_idx += 1
+            register_ids[idx] = im_id
+            start = time.time()
+            reg_result = next(results)
+            report.frame(im_id,
+                         register=time.time() - start,
+                         iterations=reg_result.iterations,
+                         failed_attempts=reg_result.failed_attempts,
+                         reference=(register_ids[reg_result.reference_idx]
+                                        if reg_result.reference_idx is not None
+                                        else None))
+            report.count('register_failed_attempts',
+                         reg_result.failed_attempts)
+            if reg_result.iterations is None:
+                report.count('register_stored')
+            else:
+                report.count('register_iterations', reg_result.iterations)
+            try:
+                M = reg_result.result()
+            except reg.RegistrationFailed as e:
+                report.count('register_failed')
+                print "Failed to register {}: {}".format(im_id, e)
+            else:
+                transforms[im_id] = M
+                registered.append((idx, star_list, M))
+                del registered[1:-reg.REGISTRATION_RETRIES]
+    if results is not reg_results:
+        results.close()
+
+def save_caches(min_interval=0.):
+    """Write any new star catalog and transform store entries to disk."""
+    if not args.no_star_cache:
+        star_catalog.save(min_interval)
+    if transform_store is not None:
+        transform_store.save(min_interval)
+
+frame_cache = frames.FrameCache(max_bytes=int(args.max_memory * 1024 * 1024),
+                                volume=frame_volume)
+
+def bounding_rect():
+    """Return the output rect, bounding all of the registered images."""
+    with report.stage('bounding_rect'):
+        rect = stack.get_bounding_rect(
+                 (frames.image_shape(paths[im_id], frame_volume), M)
                                            for im_id, M in transforms.items())
-if args.crop:
-    rect = (rect[0] + args.crop[0],
-            rect[1] + args.crop[1],
-            args.crop[2],
-            args.crop[3])
-
-stacked = None
-for im_id, M in transforms.items():
-    if stacked is None:
-        stacked = stack.StackedImage(rect)
-    stacked.add_image(ims[im_id], M)
-    if not any(times[im_id] < times[other_im_id]
-                                          <= times[im_id] + MIN_FRAME_INTERVAL
-                                        for other_im_id in transforms.keys()):
-        im = stacked.im
-        if args.black_cutoff:
-            im = im * (im > numpy.ones(im.shape) * args.black_cutoff)
-        cv2.imwrite(time.strftime(OUT_FORMAT, time.gmtime(times[im_id])), im)
-        stacked = None
+    if args.crop:
+        rect = (rect[0] + args.crop[0],
+                rect[1] + args.crop[1],
+                args.crop[2],
+                args.crop[3])
+
+    return rect
+
+def output_groups():
+    """
+    Return the registered images grouped into output images.
+
+    Returns:
+        An `OrderedDict`, mapping a tuple of the IDs of each group's images to
+        the time of its output image.
+
+    """
+    im_ids = sorted(transforms.keys(), key=times.get)
+    groups = stack.group_by_interval((times[im_id] for im_id in im_ids),
+                                     MIN_FRAME_INTERVAL)
+
+    return OrderedDict((tuple(im_ids[idx] for idx in group),
+                        times[im_ids[group[-1]]])
+                       for group in groups)
+
+def render_tiled(rect, tasks, imap):
+    """
+    Render the output images for a sequence of stacking tasks, tile by tile.
+
+    Each output image is split into the tiles of a `stack.TiledStackedImage`,
+    and a `render_group` task is made for each tile that is overlapped by at
+    least one input image, so the tiles of an image are stacked in parallel.
+    Tiles which no input image overlaps are left black. Only one output
+    image's tiles are submitted at a time, so finished tiles never pile up
+    ahead of the canvas they belong to.
+
+    Arguments:
+        rect: Bounds of the output images.
+        tasks: Sequence of `render_group` tasks, one per output image.
+        imap: Function used to map `render_group` over the tile tasks.
+
+    Returns:
+        An iterable of `(im, seconds)` pairs, like the results of
+        `render_group`, in the same order as `tasks`. `seconds` is the total
+        time spent stacking the image's tiles.
+
+    """
+    # The tile layout is the same for every output image, so it is computed
+    # once, without allocating a canvas.
+    layout = stack.TiledStackedImage(rect, tile_size=args.tile_size)
+    tile_rects = layout.tile_rects()
+    for _, paths_and_transforms, black_cutoff in tasks:
+        touched = layout.tiles_touched(
+                [frames.image_shape(path, frame_volume)
+                                      for path, M in paths_and_transforms],
+                [M for path, M in paths_and_transforms])
+        keys = [key for key, _ in tile_rects if key in touched]
+        tile_tasks = [(tile_rect,
+                       [paths_and_transforms[idx] for idx in touched[key]],
+                       black_cutoff)
+                      for key, tile_rect in tile_rects if key in touched]
+
+        canvas = stack.TiledStackedImage(rect, tile_size=args.tile_size,
+                                         memmap=args.memmap_canvas,
+                                         memmap_dir=args.memmap_dir)
+        stack_time = 0.
+        for key, (tile, tile_time) in itertools.izip(
+                keys, imap(render_group, tile_tasks)):
+            canvas.set_tile(key, tile)
+            stack_time += tile_time
+        yield canvas.im, stack_time
+
+def render_groups(rect, groups):
+    """
+    Render and write the output image for each of a sequence of groups.
+
+    Arguments:
+        rect: Bounds of the output images.
+        groups: Sequence of `(group_ids, out_time)` pairs, as returned by
+            `output_groups`.
+
+    Returns:
+        The paths of the written images.
+
+    """
+    tasks = [(rect, [(paths[im_id], transforms[im_id]) for im_id in group_ids],
+              args.black_cutoff)
+             for group_ids, out_time in groups]
+    out_ids = [time.strftime(ID_FORMAT, time.gmtime(out_time))
+                    for group_ids, out_time in groups]
+    out_paths = [time.strftime(OUT_FORMAT, time.gmtime(out_time))
+                    for group_ids, out_time in groups]
+
+    # Images are rendered (possibly in a pool of processes) in this thread,
+    # while `image_writer` encodes and writes them in a background thread.
+    print "Rendering {} stacked images".format(len(tasks))
+    animation = None
+    if args.animation:
+        animation = anim.open_animation(args.animation, delay=args.frame_delay,
+                                        delta=args.delta_frames,
+                                        processes=args.jobs)
+        if not args.keep_frames:
+            out_paths = [None] * len(out_paths)
+    image_writer = writer.ImageWriter(fmt=args.output_format,
+                                      png_compression=args.png_compression,
+                                      animation=animation)
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    imap = pool.imap if pool is not None else itertools.imap
+    if args.tile_size is not None:
+        results = render_tiled(rect, tasks, imap)
+    else:
+        results = imap(render_group, tasks)
+    with report.stage('stack'):
+        for out_id, out_path, (group_ids, _), (im, stack_time) in (
+                   itertools.izip(out_ids, out_paths, groups, results)):
+            report.frame("stacked/" + out_id, stack=stack_time,
+                         frames=len(group_ids))
+            image_writer.write(out_path, im)
+        if pool is not None:
+            pool.close()
+    with report.stage('write'):
+        image_writer.close()
+    for out_id, write_time in zip(out_ids, image_writer.write_times):
+        report.frame("stacked/" + out_id, write=write_time)
+
+    return ["{}.{}".format(out_path, args.output_format)
+                for out_path in out_paths if out_path is not None]
+
+register_frames(extract_stars(metadata))
+save_caches()
+
+print "Stacking {} / {} images".format(len(transforms), len(paths))
+rect = bounding_rect() if transforms else None
+rendered = output_groups()
+if rect is not None:
+    render_groups(rect, rendered.items())
+
+def poll():
+    """
+    Process any images which have arrived since the last poll.
+
+    The output rect is fixed by the first images to be registered. Only output
+    images whose group of input images has changed are re-rendered, and
+    output images which have been superseded are deleted.
+
+    """
+    global rect, rendered
+
+    if args.update_metadata:
+        cache.update_metadata()
+    metadata_db.sync_from_json()
+    new_metadata = [d for d in metadata_db.query(vars(args)['from'], args.to,
+                                                 args.exposure.pattern)
+                      if metadata_to_id(d) not in paths]
+    if args.download_missing:
+        cache.check_images(new_metadata, download_missing=True,
+                           volume=frame_volume)
+    else:
+        new_metadata = [d for d in new_metadata
+                          if os.path.exists(d["image_path"])]
+    if not new_metadata:
+        return
+
+    register_frames(extract_stars(new_metadata))
+    save_caches(CACHE_SAVE_INTERVAL)
+    if not transforms:
+        return
+    if rect is None:
+        rect = bounding_rect()
+
+    groups = output_groups()
+    changed = [(group_ids, out_time) for group_ids, out_time in groups.items()
+                   if group_ids not in rendered]
+    out_paths = render_groups(rect, changed)
+    for group_ids, out_time in rendered.items():
+        if group_ids not in groups:
+            out_path = "{}.{}".format(
+                           time.strftime(OUT_FORMAT, time.gmtime(out_time)),
+                           args.output_format)
+            if out_path not in out_paths and os.path.exists(out_path):
+                os.remove(out_path)
+    rendered = groups
+
+    if args.report:
+        report.save(args.report)
+
+if args.watch is not None:
+    print "Watching for new images every {} seconds".format(args.watch)
+    try:
+        while True:
+            time.sleep(args.watch)
+            # A failed download or metadata update is retried by the next
+            # poll, so it shouldn't stop the watch.
+            try:
+                poll()
+            except (fetch.FetchFailed, IOError) as e:
+                print "Poll failed, will retry: {}".format(e)
+                report.count('poll_failed')
+    except KeyboardInterrupt:
+        pass
+    save_caches()
+
+print "Peak frame cache size: {:.1f} MB, peak resident size: {:.1f} MB".format(
+           frame_cache.peak_bytes / (1024. * 1024),
+           max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.)
 
+if args.report:
+    report.save(args.report)
+    print "Wrote report to {}".format(args.report)
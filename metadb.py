@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+An indexed store of image metadata.
+
+"""
+
+__all__ = (
+    'MetadataDB',
+)
+
+import json
+import re
+import sqlite3
+
+import cache
+
+_DB_FILE = "data/images/input/metadata.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    timestamp INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    image_path TEXT NOT NULL,
+    exposure TEXT NOT NULL,
+    PRIMARY KEY (timestamp, url)
+);
+CREATE INDEX IF NOT EXISTS images_timestamp ON images (timestamp);
+CREATE TABLE IF NOT EXISTS derived (
+    timestamp INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (timestamp, name)
+);
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_COLUMNS = ('timestamp', 'url', 'image_path', 'exposure')
+
+def _regexp(pattern, s):
+    return re.match(pattern, s) is not None
+
+class MetadataDB(object):
+    """
+    Image metadata, indexed by timestamp.
+
+    This is an SQLite mirror of the JSON metadata file maintained by `cache`,
+    which allows time-range and exposure queries without reading the whole
+    archive. Arbitrary derived values can also be recorded against each frame.
+
+    """
+
+    def __init__(self, path=_DB_FILE):
+        self._conn = sqlite3.connect(path)
+        self._conn.create_function('REGEXP', 2, _regexp)
+        self._conn.executescript(_SCHEMA)
+
+    def import_metadata(self, metadata):
+        """
+        Replace the image records with `metadata` (as returned by
+        `cache.load_metadata`).
+
+        The table is rebuilt in a single transaction, so records which have
+        changed or been removed since the last import are not left behind.
+
+        """
+        with self._conn:
+            self._conn.execute("DELETE FROM images")
+            self._conn.executemany(
+                     "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                     (tuple(d[c] for c in _COLUMNS) for d in metadata))
+
+    def sync_from_json(self):
+        """
+        Import the JSON metadata file, if it has changed since it was last
+        imported.
+
+        Returns:
+            True if the file was imported.
+
+        """
+        mtime = cache.metadata_mtime()
+        if mtime is None:
+            return False
+        mtime = repr(mtime)
+        row = self._conn.execute("SELECT value FROM info WHERE key = ?",
+                                 ('json_mtime',)).fetchone()
+        if row is not None and row[0] == mtime:
+            return False
+
+        self.import_metadata(cache.load_metadata())
+        self._conn.execute("INSERT OR REPLACE INTO info VALUES (?, ?)",
+                           ('json_mtime', mtime))
+        self._conn.commit()
+        return True
+
+    def query(self, start, end, exposure=None):
+        """
+        Return metadata records in a time range.
+
+        Arguments:
+            start: Earliest timestamp to return, inclusive.
+            end: Latest timestamp to return, inclusive.
+            exposure: Optional regular expression which the start of the
+                record's exposure must match.
+
+        Returns:
+            A list of metadata dicts, in timestamp order.
+
+        """
+        sql = ("SELECT {} FROM images WHERE timestamp BETWEEN ? AND ?".format(
+                                                          ", ".join(_COLUMNS)))
+        params = [start, end]
+        if exposure is not None:
+            sql += " AND exposure REGEXP ?"
+            params.append(exposure)
+        sql += " ORDER BY timestamp"
+
+        return [dict(zip(_COLUMNS, row))
+                    for row in self._conn.execute(sql, params)]
+
+    def set_field(self, timestamp, name, value):
+        """Record a JSON-serializable derived value against a frame."""
+        self._conn.execute("INSERT OR REPLACE INTO derived VALUES (?, ?, ?)",
+                           (timestamp, name, json.dumps(value)))
+
+    def get_fields(self, timestamps, name):
+        """
+        Return a dict mapping timestamps to a derived value. Frames without
+        the value are omitted.
+
+        """
+        out = {}
+        timestamps = list(timestamps)
+        # Keep within SQLite's limit on the number of query parameters.
+        for i in range(0, len(timestamps), 500):
+            chunk = timestamps[i:i + 500]
+            out.update((t, json.loads(v)) for t, v in self._conn.execute(
+                    "SELECT timestamp, value FROM derived WHERE name = ? AND "
+                    "timestamp IN ({})".format(", ".join("?" * len(chunk))),
+                    [name] + chunk))
+
+        return out
+
+    def commit(self):
+        """Commit any derived values recorded with `set_field`."""
+        self._conn.commit()
+
+if __name__ == "__main__":
+    # Import the JSON metadata file, regardless of whether it has changed.
+    db = MetadataDB()
+    metadata = cache.load_metadata()
+    db.import_metadata(metadata)
+    print "Imported {} records".format(len(metadata))
@@ -26,16 +26,22 @@ Routines for registering images, based upon star locations.
 """
 
 __all__ = (
+    'fit_transforms',
     'RegistrationFailed',
     'RegistrationResult',
+    'register_many',
     'register_pair',
 )
 
 import collections
+import itertools
+import multiprocessing
 import random
 
 import numpy
 
+import stars
+
 # Maximum number of RANSAC iterations to run before giving up.
 MAX_ITERS = 100000
 
@@ -45,9 +51,22 @@ NUM_STARS_TO_PAIR = 4
 # Maximum permissable distance between two paired stars.
 MAX_DISTANCE = 3.0
 
+# Minimum fraction of the stars in the image with fewer stars which must fit a
+# model, for the model to be accepted when verification is requested. See
+# `_ModelVerifier`.
+MIN_INLIER_FRACTION = 0.25
+
 # Number of registrations that are tried if the initial registration fails.
 REGISTRATION_RETRIES = 3
 
+# Number of the most voted-for correspondences which are used as seeds for a
+# model, by the hashing matcher.
+HASHING_SEEDS = 10
+
+# Names of the available methods for finding correspondences. See
+# `register_pair`.
+MATCHERS = ('ransac', 'ransac-numpy', 'ransac-grid', 'hashing', 'prosac')
+
 class RegistrationFailed(Exception):
     pass
 
@@ -68,14 +87,19 @@ def _fits_model(pair, model):
 def _pick_random_model(stars1, stars2):
     return zip(random.sample(stars1, 2), random.sample(stars2, 2))
 
-def _find_correspondences(stars1, stars2):
+def _find_correspondences(stars1, stars2, stats=None, verify=False):
     """
     Find a sequence of at least NUM_STARS_TO_PAIR correspondences that form a
     consistent model.
 
+    If `stats` is a dict, the number of iterations used is stored under the
+    'iterations' key. If `verify` is True, models are only accepted if they
+    pass the checks in `_ModelVerifier`.
+
     """
     stars1 = list(stars1)
     stars2 = list(stars2)
+    verifier = _ModelVerifier(stars1, stars2) if verify else None
 
     for i in range(MAX_ITERS):
         model = _pick_random_model(stars1, stars2)
@@ -91,19 +115,388 @@ def _find_correspondences(stars1, stars2):
                 if _fits_model((s1, s2), model):
                     model.append((s1, s2))
 
-        if len(model) >= NUM_STARS_TO_PAIR:
+        if (len(model) >= NUM_STARS_TO_PAIR and
+            (verifier is None or verifier.accepts_model(model))):
+            if stats is not None:
+                stats['iterations'] = i + 1
             return model
 
+    if stats is not None:
+        stats['iterations'] = MAX_ITERS
     raise RegistrationFailed
 
-def _transformation_from_correspondences(correspondences):
+def _distance_matrix(star_list):
+    """Return a matrix of the distances between each pair of stars."""
+    pos = stars.as_star_set(star_list).positions
+    return numpy.sqrt(numpy.sum((pos[:, None, :] - pos[None, :, :]) ** 2,
+                                axis=2))
+
+def _find_correspondences_numpy(stars1, stars2, stats=None, verify=False):
+    """
+    As `_find_correspondences`, but with consistency checks done in bulk on
+    precomputed distance matrices.
+
+    The models found are exactly those that `_find_correspondences` would find
+    for the same initial pairs: Candidate pairs are first filtered against the
+    initial pairs in one array operation, and the survivors are then added in
+    the same order, subject to the same checks, as the nested loops in
+    `_find_correspondences`.
+
+    """
+    stars1 = stars.as_star_set(stars1)
+    stars2 = stars.as_star_set(stars2)
+    points1 = stars1.positions
+    points2 = stars2.positions
+    dists1 = _distance_matrix(stars1)
+    dists2 = _distance_matrix(stars2)
+    verifier = _ModelVerifier(stars1, stars2) if verify else None
+
+    for i in range(MAX_ITERS):
+        a1, b1 = random.sample(xrange(len(stars1)), 2)
+        a2, b2 = random.sample(xrange(len(stars2)), 2)
+        if abs(dists1[a1, b1] - dists2[a2, b2]) > MAX_DISTANCE:
+            continue
+
+        consistent = (
+            (numpy.abs(dists1[:, a1, None] - dists2[None, :, a2]) <=
+                                                               MAX_DISTANCE) &
+            (numpy.abs(dists1[:, b1, None] - dists2[None, :, b2]) <=
+                                                               MAX_DISTANCE))
+        consistent[[a1, b1], :] = False
+        consistent[:, [a2, b2]] = False
+        idxs1, idxs2 = numpy.nonzero(consistent)
+        if len(idxs1) + 2 < NUM_STARS_TO_PAIR:
+            continue
+
+        model1 = [a1, b1]
+        model2 = [a2, b2]
+        for s1, s2 in zip(idxs1, idxs2):
+            if s2 in model2:
+                continue
+            if numpy.all(numpy.abs(dists1[s1, model1] - dists2[s2, model2]) <=
+                                                                 MAX_DISTANCE):
+                model1.append(s1)
+                model2.append(s2)
+
+        if (len(model1) >= NUM_STARS_TO_PAIR and
+            (verifier is None or
+             verifier.accepts(points1[model1], points2[model2]))):
+            if stats is not None:
+                stats['iterations'] = i + 1
+            return [(stars1[s1], stars2[s2]) for s1, s2 in zip(model1, model2)]
+
+    if stats is not None:
+        stats['iterations'] = MAX_ITERS
+    raise RegistrationFailed
+
+class _StarGrid(object):
+    """
+    Stars bucketed into a grid of MAX_DISTANCE sized cells, so that the stars
+    near a point can be found without checking every star.
+
+    """
+
+    def __init__(self, star_list):
+        self._positions = stars.as_star_set(star_list).positions
+        self._cells = collections.defaultdict(list)
+        for idx, (x, y) in enumerate(self._positions.tolist()):
+            self._cells[self._cell(x, y)].append(idx)
+
+    @staticmethod
+    def _cell(x, y):
+        return (int(numpy.floor(x / MAX_DISTANCE)),
+                int(numpy.floor(y / MAX_DISTANCE)))
+
+    def nearest(self, x, y):
+        """
+        Return the index of the nearest star to a point, or None if no star is
+        within MAX_DISTANCE.
+
+        """
+        cx, cy = self._cell(x, y)
+        best_idx, best_dist = None, MAX_DISTANCE
+        for idx in itertools.chain.from_iterable(
+                    self._cells.get((cx + dx, cy + dy), ())
+                    for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+            sx, sy = self._positions[idx]
+            d = numpy.hypot(sx - x, sy - y)
+            if d <= best_dist:
+                best_idx, best_dist = idx, d
+
+        return best_idx
+
+def _grid_inliers(grid, projected):
+    """
+    Return `(idx1, idx2)` pairs of each projected star in the first image, and
+    the star in the second image which is nearest to it, if any. Each star in
+    the second image is used at most once.
+
+    """
+    model = []
+    used = set()
+    for idx1, (x, y) in enumerate(projected.tolist()):
+        idx2 = grid.nearest(x, y)
+        if idx2 is not None and idx2 not in used:
+            used.add(idx2)
+            model.append((idx1, idx2))
+
+    return model
+
+class _ModelVerifier(object):
+    """
+    Checks a matcher's candidate model before it is accepted.
+
+    Distances between stars can't distinguish a set of correspondences from
+    its mirror image, and in dense star fields a model of only a few stars may
+    be consistent by chance. A model passes if the least squares
+    transformation for its correspondences maps each of them to within
+    MAX_DISTANCE, and also maps at least `MIN_INLIER_FRACTION` of the stars
+    (and at least NUM_STARS_TO_PAIR) to within MAX_DISTANCE of a star in the
+    second image.
+
+    """
+
+    def __init__(self, stars1, stars2):
+        stars1 = stars.as_star_set(stars1)
+        stars2 = stars.as_star_set(stars2)
+        self._points1 = stars1.positions
+        self._grid = _StarGrid(stars2)
+        self._min_inliers = max(NUM_STARS_TO_PAIR,
+                                MIN_INLIER_FRACTION * min(len(stars1),
+                                                          len(stars2)))
+
+    def accepts(self, points1, points2):
+        """
+        Return True if the model with correspondences between the rows of the
+        `(N, 2)` arrays `points1` and `points2` should be accepted.
+
+        """
+        M = numpy.asarray(_transformation_from_points(points1, points2))
+        residuals = points1.dot(M[:2, :2].T) + M[:2, 2] - points2
+        if numpy.any(numpy.hypot(residuals[:, 0], residuals[:, 1]) >
+                                                                MAX_DISTANCE):
+            return False
+
+        projected = self._points1.dot(M[:2, :2].T) + M[:2, 2]
+        return len(_grid_inliers(self._grid, projected)) >= self._min_inliers
+
+    def accepts_model(self, model):
+        """As `accepts`, for a sequence of `(star1, star2)` pairs."""
+        return self.accepts(
+                   numpy.array([s1.pos for s1, s2 in model], dtype=float),
+                   numpy.array([s2.pos for s1, s2 in model], dtype=float))
+
+def _find_correspondences_grid(stars1, stars2, stats=None, verify=False):
+    """
+    As `_find_correspondences`, but with inliers found by projecting the
+    stars in the first image with the transformation implied by each initial
+    pair, and looking up the nearest star in the second image in a
+    `_StarGrid`.
+
+    This makes gathering inliers O(n) in the number of stars, rather than
+    O(n^2).
+
+    """
+    stars1 = stars.as_star_set(stars1)
+    stars2 = stars.as_star_set(stars2)
+    grid = _StarGrid(stars2)
+    points1 = stars1.positions
+    points2 = stars2.positions
+    dists1 = _distance_matrix(stars1)
+    dists2 = _distance_matrix(stars2)
+    verifier = _ModelVerifier(stars1, stars2) if verify else None
+
+    for i in range(MAX_ITERS):
+        a1, b1 = random.sample(xrange(len(stars1)), 2)
+        a2, b2 = random.sample(xrange(len(stars2)), 2)
+        if abs(dists1[a1, b1] - dists2[a2, b2]) > MAX_DISTANCE:
+            continue
+
+        M = numpy.asarray(_transformation_from_points(points1[[a1, b1]],
+                                                      points2[[a2, b2]]))
+        model = _grid_inliers(grid, points1.dot(M[:2, :2].T) + M[:2, 2])
+
+        if len(model) < NUM_STARS_TO_PAIR:
+            continue
+        idxs1, idxs2 = map(list, zip(*model))
+        if verifier is None or verifier.accepts(points1[idxs1],
+                                                points2[idxs2]):
+            if stats is not None:
+                stats['iterations'] = i + 1
+            return [(stars1[s1], stars2[s2]) for s1, s2 in model]
+
+    if stats is not None:
+        stats['iterations'] = MAX_ITERS
+    raise RegistrationFailed
+
+def _find_correspondences_hashing(stars1, stars2, stats=None,
+                                  verify=False):
+    """
+    Find a sequence of at least NUM_STARS_TO_PAIR correspondences that form a
+    consistent model, using an index of pairwise star distances.
+
+    Distances between stars are invariant under rotation and translation, so
+    each pair of stars in the first image whose distance matches that of a
+    pair in the second image votes for the correspondences it implies. Models
+    are then grown greedily from the most voted-for correspondences. Each
+    seed correspondence counts as an iteration in `stats`.
+
+    """
+    stars1 = list(stars1)
+    stars2 = list(stars2)
+    verifier = _ModelVerifier(stars1, stars2) if verify else None
+    dists1 = _distance_matrix(stars1).tolist()
+    dists2 = _distance_matrix(stars2).tolist()
+
+    # Index each pair of stars in the second image by their distance, in
+    # buckets of width MAX_DISTANCE.
+    index = collections.defaultdict(list)
+    for k, l in itertools.combinations(range(len(stars2)), 2):
+        d = dists2[k][l]
+        index[int(d / MAX_DISTANCE)].append((d, k, l))
+
+    # A matching pair may correspond in either order, so vote for both.
+    votes = numpy.zeros((len(stars1), len(stars2)), dtype=numpy.int64)
+    for i, j in itertools.combinations(range(len(stars1)), 2):
+        d = dists1[i][j]
+        bucket = int(d / MAX_DISTANCE)
+        for d2, k, l in itertools.chain(index[bucket - 1], index[bucket],
+                                        index[bucket + 1]):
+            if abs(d - d2) <= MAX_DISTANCE:
+                votes[i, k] += 1
+                votes[j, l] += 1
+                votes[i, l] += 1
+                votes[j, k] += 1
+
+    # A correspondence in a model of N stars receives at least N - 1 votes.
+    candidates = [divmod(c, len(stars2))
+                    for c in numpy.argsort(votes, axis=None)[::-1]
+                    if votes.flat[c] >= NUM_STARS_TO_PAIR - 1]
+
+    best_model = []
+    for seed in candidates[:HASHING_SEEDS]:
+        model = [(stars1[seed[0]], stars2[seed[1]])]
+        used1, used2 = {seed[0]}, {seed[1]}
+        for i, k in candidates:
+            if (i not in used1 and k not in used2 and
+                _fits_model((stars1[i], stars2[k]), model)):
+                model.append((stars1[i], stars2[k]))
+                used1.add(i)
+                used2.add(k)
+        if (len(model) > len(best_model) and
+            (verifier is None or verifier.accepts_model(model))):
+            best_model = model
+
+    if stats is not None:
+        stats['iterations'] = len(candidates[:HASHING_SEEDS])
+    if len(best_model) < NUM_STARS_TO_PAIR:
+        raise RegistrationFailed
+    return best_model
+
+def _by_flux(star_list):
+    """
+    Return a `stars.StarSet` sorted brightest first. Stars without a flux keep
+    their order, after any stars with a flux.
+
+    """
+    star_set = stars.as_star_set(star_list)
+    flux = star_set.array['flux']
+    return star_set[numpy.argsort(-numpy.where(numpy.isnan(flux), 0., flux),
+                                  kind='mergesort')]
+
+def _prosac_hypotheses(n1, n2):
+    """
+    Yield `((a1, b1), (a2, b2))` pairs of star indices, such that hypotheses
+    drawn from the first `n` stars of each image are all yielded before any
+    which involve the `n + 1`th star of either image.
+
+    """
+    for n in range(2, max(n1, n2) + 1):
+        m1, m2 = min(n, n1), min(n, n2)
+
+        # Pairs in the first image are unordered, whereas pairs in the second
+        # image are ordered, so that both assignments are tried.
+        if n <= n1:
+            new_pairs1 = [(a1, m1 - 1) for a1 in range(m1 - 1)]
+            old_pairs1 = list(itertools.combinations(range(m1 - 1), 2))
+        else:
+            new_pairs1 = []
+            old_pairs1 = list(itertools.combinations(range(m1), 2))
+        pairs2 = list(itertools.permutations(range(m2), 2))
+        new_pairs2 = ([p for p in pairs2 if m2 - 1 in p] if n <= n2 else [])
+
+        for hypothesis in itertools.product(new_pairs1, pairs2):
+            yield hypothesis
+        for hypothesis in itertools.product(old_pairs1, new_pairs2):
+            yield hypothesis
+
+def _find_correspondences_prosac(stars1, stars2, stats=None, verify=False):
+    """
+    As `_find_correspondences_grid`, but with initial pairs drawn from the
+    brightest stars first, in the manner of PROSAC.
+
+    Bright stars are the most likely to be found in both images, so for most
+    image pairs a consistent model is found within a handful of iterations.
+    Stars are ordered by their `flux`, so this degrades to an exhaustive
+    search in extraction order for stars without a flux. Rather than fitting
+    a least squares transformation to each initial pair, the rotation and
+    translation are computed directly, which guarantees that the
+    transformation is not a reflection.
+
+    """
+    stars1 = _by_flux(stars1)
+    stars2 = _by_flux(stars2)
+    grid = _StarGrid(stars2)
+    points1 = stars1.positions
+    points2 = stars2.positions
+    dists1 = _distance_matrix(stars1)
+    dists2 = _distance_matrix(stars2)
+    verifier = _ModelVerifier(stars1, stars2) if verify else None
+
+    i = -1
+    for i, ((a1, b1), (a2, b2)) in enumerate(
+                itertools.islice(_prosac_hypotheses(len(stars1), len(stars2)),
+                                 MAX_ITERS)):
+        if abs(dists1[a1, b1] - dists2[a2, b2]) > MAX_DISTANCE:
+            continue
+
+        v1 = points1[b1] - points1[a1]
+        v2 = points2[b2] - points2[a2]
+        theta = numpy.arctan2(v2[1], v2[0]) - numpy.arctan2(v1[1], v1[0])
+        R = numpy.array([[numpy.cos(theta), -numpy.sin(theta)],
+                         [numpy.sin(theta), numpy.cos(theta)]])
+        T = (points2[a2] + points2[b2] - R.dot(points1[a1] + points1[b1])) / 2.
+        model = _grid_inliers(grid, points1.dot(R.T) + T)
+
+        if len(model) < NUM_STARS_TO_PAIR:
+            continue
+        idxs1, idxs2 = map(list, zip(*model))
+        if verifier is None or verifier.accepts(points1[idxs1],
+                                                points2[idxs2]):
+            if stats is not None:
+                stats['iterations'] = i + 1
+            return [(stars1[s1], stars2[s2]) for s1, s2 in model]
+
+    if stats is not None:
+        stats['iterations'] = i + 1
+    raise RegistrationFailed
+
+_MATCHER_FUNCS = {
+    'ransac': _find_correspondences,
+    'ransac-numpy': _find_correspondences_numpy,
+    'ransac-grid': _find_correspondences_grid,
+    'hashing': _find_correspondences_hashing,
+    'prosac': _find_correspondences_prosac,
+}
+
+def _transformation_from_points(points1, points2):
     """
     Return an affine transformation [R | T] such that:
 
         sum ||R*p1,i + T - p2,i||^2
 
-    is minimized. Where p1,i and p2,i is the position vector of the first and
-    second star in the i'th correspondence, respectively.
+    is minimized. Where p1,i and p2,i are the i'th rows of the `(N, 2)` arrays
+    `points1` and `points2`, respectively.
 
     """
     # The algorithm proceeds by first subtracting the centroid from each set of
@@ -111,35 +504,116 @@ def _transformation_from_correspondences(correspondences):
     # sought which maps the translated points1 onto points2. The SVD is used to
     # do this. See:
     #   https://en.wikipedia.org/wiki/Orthogonal_Procrustes_problem
-    points1 = numpy.vstack(s1.pos_vec.T for s1, s2 in correspondences)
-    points2 = numpy.vstack(s2.pos_vec.T for s1, s2 in correspondences)
+    c1 = numpy.sum(points1, axis=0) / points1.shape[0]
+    c2 = numpy.sum(points2, axis=0) / points2.shape[0]
 
-    def centroid(points):
-        return numpy.sum(points, axis=0) / points.shape[0]
-    c1 = centroid(points1)
-    c2 = centroid(points2)
+    U, S, Vt = numpy.linalg.svd((points1 - c1).T.dot(points2 - c2))
 
-    points1 -= c1
-    points2 -= c2
-
-    U, S, Vt = numpy.linalg.svd(points1.T * points2)
+    # With only a couple of correspondences (or noisy ones) the best
+    # orthogonal matrix can be a reflection. Flip the sign of the last
+    # singular vector so that R is always a proper rotation. See:
+    #   https://en.wikipedia.org/wiki/Kabsch_algorithm
+    if numpy.linalg.det(U.dot(Vt)) < 0:
+        Vt[-1] *= -1
 
     # The R we seek is in fact the transpose of the one given by U * Vt. This
     # is because the above formulation assumes the matrix goes on the right
     # (with row vectors) where as our solution requires the matrix to be on the
     # left (with column vectors).
-    R = (U * Vt).T
+    R = U.dot(Vt).T
+
+    M = numpy.identity(3)
+    M[:2, :2] = R
+    M[:2, 2] = c2 - R.dot(c1)
 
-    return numpy.vstack([numpy.hstack((R, c2.T - R * c1.T)),
-                         numpy.matrix([0., 0., 1.])])
+    return numpy.matrix(M)
 
-def register_pair(stars1, stars2):
+def fit_transforms(points1, points2, counts=None):
+    """
+    Solve many of the problems solved by `_transformation_from_points` at once.
+
+    The problems are solved together with a single stacked SVD, rather than
+    one at a time.
+
+    Arguments:
+        points1: A `(B, N, 2)` array, where `points1[b]` holds the points in
+            the first image of the `b`'th problem.
+        points2: A `(B, N, 2)` array of the corresponding points in the second
+            image of each problem.
+        counts: Optional sequence of `B` point counts. If given, only the first
+            `counts[b]` points of problem `b` are used, so problems with
+            differing numbers of points can be padded (with any finite values)
+            to the same size.
+
+    Returns:
+        A `(B, 3, 3)` array of affine transformations, each mapping points in
+        the first image onto points in the second image.
+
+    """
+    points1 = numpy.asarray(points1, dtype=numpy.float64)
+    points2 = numpy.asarray(points2, dtype=numpy.float64)
+    num_problems, num_points = points1.shape[:2]
+    if counts is None:
+        counts = numpy.full(num_problems, num_points)
+    counts = numpy.asarray(counts)
+
+    # Padding points are given zero weight.
+    weights = (numpy.arange(num_points)[None, :] <
+               counts[:, None]).astype(numpy.float64)[:, :, None]
+    c1 = (numpy.sum(points1 * weights, axis=1) / counts[:, None])
+    c2 = (numpy.sum(points2 * weights, axis=1) / counts[:, None])
+
+    H = numpy.einsum('bni,bnj->bij',
+                     (points1 - c1[:, None, :]) * weights,
+                     points2 - c2[:, None, :])
+    U, S, Vt = numpy.linalg.svd(H)
+
+    # As in `_transformation_from_points`, reflections are replaced with the
+    # closest rotation, and R is the transpose of U * Vt.
+    Vt[numpy.linalg.det(numpy.einsum('bij,bjk->bik', U, Vt)) < 0, -1] *= -1
+    R = numpy.einsum('bij,bjk->bki', U, Vt)
+
+    out = numpy.zeros((num_problems, 3, 3))
+    out[:, :2, :2] = R
+    out[:, :2, 2] = c2 - numpy.einsum('bij,bj->bi', R, c1)
+    out[:, 2, 2] = 1.
+
+    return out
+
+def _transformation_from_correspondences(correspondences):
+    """
+    As `_transformation_from_points`, where p1,i and p2,i is the position of
+    the first and second star in the i'th correspondence, respectively.
+
+    """
+    points1 = numpy.array([s1.pos for s1, s2 in correspondences],
+                          dtype=numpy.float64)
+    points2 = numpy.array([s2.pos for s1, s2 in correspondences],
+                          dtype=numpy.float64)
+
+    return _transformation_from_points(points1, points2)
+
+def register_pair(stars1, stars2, matcher='ransac', stats=None,
+                  verify=False):
     """
     Align a pair of images, based on their stars.
 
     Arguments:
         stars1: The stars in the first image.
         stars2: The stars in the second image.
+        matcher: One of `MATCHERS`. 'ransac' samples random pairs of stars,
+            and 'ransac-numpy' does the same with vectorized consistency
+            checks. 'ransac-grid' gathers inliers by projecting stars with
+            each hypothesis and looking up their nearest neighbours, whereas
+            'hashing' looks up matching pairs of stars in an index of pairwise
+            star distances. 'prosac' is as 'ransac-grid', but tries pairs of
+            the brightest stars first.
+        stats: Optional dict, in which the number of iterations used by the
+            matcher is stored under the 'iterations' key.
+        verify: If True, a candidate model is only accepted if its least
+            squares fit maps a reasonable fraction of all the stars onto a
+            star (see `_ModelVerifier`). This rejects mirrored models and
+            models which fit a few stars by chance, at some cost in speed.
 
     Returns:
         A 3x3 affine transformation matrix, mapping star coordinates in the
@@ -147,28 +621,117 @@ def register_pair(stars1, stars2):
 
     """
     return _transformation_from_correspondences(
-                                         _find_correspondences(stars1, stars2))
+                       _MATCHER_FUNCS[matcher](stars1, stars2, stats=stats,
+                                               verify=verify))
 
 class RegistrationResult(collections.namedtuple('_RegistrationResultBase',
-                            ('exception', 'transform'))):
+                            ('exception', 'transform', 'reference_idx',
+                             'iterations', 'failed_attempts'))):
     """
     The result of a single image's registration.
    
     One of these is returned for each input image in a `register_many` call.
+    `reference_idx` is the index (in the `register_many` input sequence) of the
+    image which this image was registered against, or None if registration
+    failed or the image is not known.
+
+    `iterations` is the total number of matcher iterations used over all
+    attempts, or None if the result was not computed (eg. it came from a
+    store). `failed_attempts` is the number of images which registration was
+    attempted against without success.
 
     """
+    def __new__(cls, exception, transform, reference_idx=None,
+                iterations=None, failed_attempts=0):
+        return super(RegistrationResult, cls).__new__(cls, exception,
+                                                      transform, reference_idx,
+                                                      iterations,
+                                                      failed_attempts)
+
     def result(self):
         if self.exception:
             raise self.exception
         return self.transform
 
-def register_many(stars_seq, reference_idx=0):
+def _register_against(candidates, stars2, matcher, verify=False):
+    """
+    Register an image against each of a sequence of registered images in turn.
+
+    Arguments:
+        candidates: Sequence of `(idx, stars, M)` tuples, where `M` is the
+            transformation from the reference image to the image with index
+            `idx`.
+        stars2: The stars in the image to be registered.
+        matcher, verify: Passed to `register_pair`.
+
+    Returns:
+        A `RegistrationResult` for the first successful registration, or a
+        failed `RegistrationResult` if none succeed.
+
+    """
+    iterations = 0
+    for failed_attempts, (idx1, stars1, M1) in enumerate(candidates):
+        stats = {}
+        try:
+            M2 = register_pair(stars1, stars2, matcher=matcher, stats=stats,
+                               verify=verify)
+        except RegistrationFailed:
+            continue
+        finally:
+            iterations += stats.get('iterations', 0)
+        return RegistrationResult(exception=None, transform=(M1 * M2),
+                                  reference_idx=idx1, iterations=iterations,
+                                  failed_attempts=failed_attempts)
+
+    return RegistrationResult(exception=RegistrationFailed(), transform=None,
+                              iterations=iterations,
+                              failed_attempts=len(candidates))
+
+def _register_pair_task(task):
+    """
+    Register a pair of images.
+
+    This is run in worker processes by `register_many` when `jobs` is greater
+    than one.
+
+    Returns:
+        A `(M, iterations)` pair, where `M` is None if registration failed.
+
+    """
+    stars1, stars2, matcher, verify = task
+    stats = {}
+    try:
+        M = register_pair(stars1, stars2, matcher=matcher, stats=stats,
+                          verify=verify)
+    except RegistrationFailed:
+        M = None
+
+    return M, stats.get('iterations', 0)
+
+def register_many(stars_seq, reference_idx=0, store=None, matcher='ransac',
+                  jobs=1, verify=False, registered=None):
     """
     Register a sequence of images, based on their stars.
 
     Arguments:
         stars_list: A list of iterables of stars. Each element corresponds with
             the stars from a particular image.
+        store: Optional persistent store of previous registrations, such as a
+            `catalog.TransformStore`. Images with a stored result are not
+            re-registered, and new results are recorded in the store.
+        matcher, verify: Passed to `register_pair`.
+        jobs: Number of processes to use. If greater than one, every image is
+            registered against the reference image concurrently, and only
+            those that fail are retried (sequentially) against other images.
+            The whole of `stars_seq` is read before the first result after
+            the reference is produced.
+        registered: Optional list of `(idx, stars, M)` tuples of images which
+            have already been registered, for example by an earlier call,
+            starting with the reference image. `M` is each image's
+            transformation. The images in `stars_seq` are registered as
+            though they followed the last of these images in one sequence,
+            and are numbered on from its `idx`. No result is produced for the
+            reference image.
 
     Returns:
         An iterable of `RegistrationResult`, with one per input image. The
@@ -180,28 +743,86 @@ def register_many(stars_seq, reference_idx=0):
     """
     stars_it = iter(stars_seq)
 
-    # The first image is used as the reference, so has the identity
-    # transformation.
-    registered = [(next(stars_it), numpy.matrix(numpy.identity(3)))]
-    yield RegistrationResult(exception=None, transform=registered[0][1])
+    # Unless registration is continuing from earlier images, the first image is
+    # used as the reference, so has the identity transformation.
+    if registered is None:
+        registered = [(0, next(stars_it), numpy.matrix(numpy.identity(3)))]
+        yield RegistrationResult(exception=None, transform=registered[0][2],
+                                 reference_idx=0, iterations=0)
+    else:
+        registered = list(registered)
+
+    # In parallel mode, attempt to register each image against the reference
+    # image up front, skipping those which already have a stored successful
+    # result. (Whether a stored failure applies depends on which images end up
+    # being tried, so those images are attempted anyway.) `first_attempts`
+    # yields `(idx, (M, iterations))` pairs in order, where `M` is None if the
+    # registration failed.
+    frames = enumerate(stars_it, registered[-1][0] + 1)
+    first_attempts = iter(())
+    pool = None
+    if jobs > 1:
+        frames = list(frames)
+        todo = []
+        for idx, stars2 in frames:
+            stored = (store.lookup(registered[:1], stars2, matcher, verify)
+                                              if store is not None else None)
+            if stored is None or stored.exception is not None:
+                todo.append((idx, stars2))
+        pool = multiprocessing.Pool(jobs)
+        first_attempts = itertools.izip(
+                   (idx for idx, stars2 in todo),
+                   pool.imap(_register_pair_task,
+                             ((registered[0][1], stars2, matcher, verify)
+                                                  for idx, stars2 in todo)))
+    next_attempt = next(first_attempts, None)
 
     # For each other image, first attempt to register it with the first image,
     # and then with the last `REGISTRATION_RETRIES` successfully registered
     # images. This seems to give good success rates, while not having too much
     # drift.
-    for stars2 in stars_it:
-        for stars1, M1 in [registered[0]] + registered[-REGISTRATION_RETRIES:]:
-            try:
-                M2 = register_pair(stars1, stars2)
-            except RegistrationFailed as e:
-                continue
-            else:
-                yield RegistrationResult(exception=None, transform=(M1 * M2))
-                break
-        else:
-            yield RegistrationResult(exception=RegistrationFailed(),
-                                     transform=None)
-        registered.append((stars2, (M1 * M2)))
+    try:
+        for idx, stars2 in frames:
+            candidates = [registered[0]] + registered[-REGISTRATION_RETRIES:]
+
+            # Take this image's first attempt (if any) even if a stored result
+            # is used, so that `next_attempt` stays in step with `frames`.
+            first_attempt = None
+            if next_attempt is not None and next_attempt[0] == idx:
+                first_attempt = next_attempt[1]
+                next_attempt = next(first_attempts, None)
+
+            reg_result = None
+            if store is not None:
+                reg_result = store.lookup(candidates, stars2, matcher, verify)
+            if reg_result is None:
+                if first_attempt is not None:
+                    M2, iterations = first_attempt
+                    if M2 is not None:
+                        reg_result = RegistrationResult(
+                                  exception=None,
+                                  transform=(registered[0][2] * M2),
+                                  reference_idx=0,
+                                  iterations=iterations)
+                    else:
+                        reg_result = _register_against(candidates[1:], stars2,
+                                                       matcher, verify)
+                        reg_result = reg_result._replace(
+                             iterations=reg_result.iterations + iterations,
+                             failed_attempts=reg_result.failed_attempts + 1)
+                else:
+                    reg_result = _register_against(candidates, stars2,
+                                                   matcher, verify)
+                if store is not None:
+                    store.record(candidates, stars2, reg_result, matcher,
+                                 verify)
+
+            yield reg_result
+            if reg_result.exception is None:
+                registered.append((idx, stars2, reg_result.transform))
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 def _draw_correspondences(correspondences, im1, im2, stars1, stars2):
     """
@@ -275,11 +896,15 @@ if __name__ == "__main__":
 
     import cv2
 
+    import frames
     import stars
+    import volume
+
+    frame_volume = volume.open_volume()
 
     if sys.argv[1] == "register_pair":
-        im1 = cv2.imread(sys.argv[2], cv2.IMREAD_GRAYSCALE)
-        im2 = cv2.imread(sys.argv[3], cv2.IMREAD_GRAYSCALE)
+        im1 = frames.load_image(sys.argv[2], frame_volume)
+        im2 = frames.load_image(sys.argv[3], frame_volume)
         stars1 = stars.extract(im1)
         stars2 = stars.extract(im2)
 
@@ -287,8 +912,8 @@ if __name__ == "__main__":
 
         print A
     if sys.argv[1] == "draw_correspondences":
-        im1 = cv2.imread(sys.argv[2], cv2.IMREAD_GRAYSCALE)
-        im2 = cv2.imread(sys.argv[3], cv2.IMREAD_GRAYSCALE)
+        im1 = frames.load_image(sys.argv[2], frame_volume)
+        im2 = frames.load_image(sys.argv[3], frame_volume)
         stars1 = list(stars.extract(im1))
         stars2 = list(stars.extract(im2))
 
@@ -300,13 +925,13 @@ if __name__ == "__main__":
         ims = []
         for fname in fnames:
             print "Loading {}".format(fname)
-            ims.append(cv2.imread(fname, cv2.IMREAD_GRAYSCALE))
+            ims.append(frames.load_image(fname, frame_volume))
 
         stars_list = []
         for fname, im in zip(fnames, ims):
             try:
                 print "Extracting stars from {}".format(fname)
-                stars_list.append((fname, list(stars.extract(im))))
+                stars_list.append((fname, stars.extract(im)))
             except stars.ExtractFailed as e:
                 print "Failed to extract stars from {}".format(fname)
 
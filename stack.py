@@ -26,14 +26,21 @@ Routines for stacking registered images.
 
 __all__ = (
     'get_bounding_rect',
+    'group_by_interval',
+    'project_corners',
     'StackedImage',
+    'TiledStackedImage',
 )
 
 import collections
+import tempfile
 
 import cv2
 import numpy
 
+# Default width and height of the tiles of a `TiledStackedImage`.
+TILE_SIZE = 1024
+
 class _BoundingRect(collections.namedtuple('_Rect', ('x', 'y', 'w', 'h'))):
     """
     A rectangle which bounds a set of points.
@@ -74,6 +81,39 @@ def _translate_matrix(v):
 
     return out
 
+def project_corners(shapes, transforms):
+    """
+    Project the corners of many images into the reference coordinate frame.
+
+    All of the transformations are inverted with a single batched call, and
+    the corners are projected together.
+
+    Arguments:
+        shapes: A `(B, 2)` array-like of image `(height, width)` shapes.
+        transforms: A `(B, 3, 3)` array-like of transformations, each of which
+            converts points in the reference coordinate frame into the
+            corresponding image's coordinate frame.
+
+    Returns:
+        A `(B, 4, 2)` array of `(x, y)` corner coordinates in the reference
+        coordinate frame.
+
+    """
+    shapes = numpy.asarray(shapes, dtype=numpy.float64).reshape(-1, 2)
+    transforms = numpy.asarray(transforms,
+                               dtype=numpy.float64).reshape(-1, 3, 3)
+
+    h, w = shapes[:, 0], shapes[:, 1]
+    zeros, ones = numpy.zeros_like(h), numpy.ones_like(h)
+    corners = numpy.array([[zeros, w, zeros, w],
+                           [zeros, zeros, h, h],
+                           [ones, ones, ones, ones]]).transpose(2, 0, 1)
+
+    points = numpy.einsum('bij,bjk->bki', numpy.linalg.inv(transforms),
+                          corners)
+
+    return points[:, :, :2]
+
 def get_bounding_rect(ims_and_transforms):
     """
     Return a bounding rectangle for a set of (image, transformation) pairs.
@@ -81,24 +121,52 @@ def get_bounding_rect(ims_and_transforms):
     Argument:
         ims_and_transforms: Sequence of image and transformation matrices. Each
             element is an `(im, M)` pair, where `M` converts points in a
-            reference coordinate frame into the image's coordinate frame.
+            reference coordinate frame into the image's coordinate frame. `im`
+            may be an image, or just its `(height, width)` shape.
 
     """
+    shapes, transforms = [], []
+    for im, M in ims_and_transforms:
+        shapes.append(getattr(im, 'shape', im)[:2])
+        transforms.append(M)
+    points = project_corners(shapes, transforms).reshape(-1, 2)
 
-    def im_corners(im):
-        return numpy.matrix([[0, 0],
-                             [0, im.shape[0]],
-                             [im.shape[1], 0],
-                             [im.shape[1], im.shape[0]]],
-                            dtype=numpy.float64).T
+    rect = _BoundingRect.from_points(numpy.matrix(points).T)
 
-    points = numpy.hstack([M.I * numpy.vstack([im_corners(im),
-                                               numpy.ones((1, 4))])
-                           for im, M in ims_and_transforms])
+    return (rect.x, rect.y, rect.w, rect.h)
 
-    rect = _BoundingRect.from_points(points)
+def group_by_interval(times, interval):
+    """
+    Split a sorted sequence of times into groups of nearby times.
 
-    return (rect.x, rect.y, rect.w, rect.h)
+    A group ends at time `t` if there is no later time in `(t, t + interval]`.
+    The sequence is scanned once, so this is linear in the number of times.
+
+    Arguments:
+        times: Sequence of times, in non-decreasing order.
+        interval: Maximum gap between consecutive distinct times in a group.
+
+    Returns:
+        A list of groups. Each group is a list of indices into `times`.
+
+    """
+    times = list(times)
+    groups = []
+    group = []
+    next_idx = 0
+    for idx, t in enumerate(times):
+        group.append(idx)
+
+        # Find the first strictly later time.
+        next_idx = max(next_idx, idx + 1)
+        while next_idx < len(times) and times[next_idx] <= t:
+            next_idx += 1
+
+        if next_idx == len(times) or times[next_idx] > t + interval:
+            groups.append(group)
+            group = []
+
+    return groups
 
 class StackedImage(object):
     """
@@ -139,18 +207,197 @@ class StackedImage(object):
 
         """
         self._rect = _BoundingRect(*rect)
-        self._im = numpy.zeros((self._rect.h, self._rect.w),
+        self._im = numpy.zeros((int(self._rect.h), int(self._rect.w)),
                                dtype=numpy.uint8)
 
     @property
     def im(self):
         return self._im
 
+    def _footprint(self, im, M):
+        """
+        Return the `(x0, y0, x1, y1)` region of the output image which an input
+        image covers, or None if it lies entirely outside the output image.
+
+        """
+        points = (project_corners([im.shape], [M])[0].T -
+                  numpy.asarray(self._rect.corners[:, 0]))
+
+        # Allow a pixel either side for interpolation.
+        x0 = max(0, int(numpy.floor(points[0].min())) - 1)
+        y0 = max(0, int(numpy.floor(points[1].min())) - 1)
+        x1 = min(self._im.shape[1], int(numpy.ceil(points[0].max())) + 1)
+        y1 = min(self._im.shape[0], int(numpy.ceil(points[1].max())) + 1)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        return x0, y0, x1, y1
+
     def add_image(self, im, M):
+        """
+        Add an image to the stack.
+
+        Only the region of the output image which the input image covers is
+        warped into, so the cost is proportional to the overlap rather than to
+        the size of the output image. Images which don't overlap the output
+        image at all are skipped.
+
+        Arguments:
+            im: The image to add.
+            M: Transformation matrix which converts points in the reference
+                coordinate frame into `im`'s coordinate frame.
+
+        """
+        footprint = self._footprint(im, M)
+        if footprint is None:
+            return
+        self._warp_region(im, M, *footprint)
+
+    def _warp_region(self, im, M, x0, y0, x1, y1):
+        """Warp an image into the `(x0, y0, x1, y1)` region of the output."""
+        origin = self._rect.corners[:, 0] + numpy.matrix([[x0], [y0]])
         cv2.warpAffine(im,
-                       (M * _translate_matrix(self._rect.corners[:, 0]))[:2],
-                       tuple(int(x) for x in self._rect.size),
-                       dst=self._im,
+                       (M * _translate_matrix(origin))[:2],
+                       (x1 - x0, y1 - y0),
+                       dst=self._im[y0:y1, x0:x1],
                        borderMode=cv2.BORDER_TRANSPARENT,
                        flags=cv2.WARP_INVERSE_MAP)
 
+class TiledStackedImage(StackedImage):
+    """
+    A `StackedImage` whose output image is divided into square tiles.
+
+    Each input image is only warped into the tiles it overlaps. Alternatively
+    the tiles can be stacked independently, for example in separate
+    processes: Use `tiles_touched` to find which input images overlap each
+    tile, stack each of the `tile_rects` with a `StackedImage`, and pass the
+    results to `set_tile`:
+
+        stacked = TiledStackedImage(rect)
+        touched = stacked.tiles_touched([im.shape for im in ims], transforms)
+        for key, tile_rect in stacked.tile_rects():
+            tile = StackedImage(tile_rect)
+            for idx in touched.get(key, []):
+                tile.add_image(ims[idx], transforms[idx])
+            stacked.set_tile(key, tile.im)
+
+    Tiles are stacked with the same interpolation as `StackedImage`, although
+    a few pixels may differ slightly due to rounding. The output image can be
+    memory-mapped onto a temporary file, so that outputs which are larger than
+    the available memory can be produced.
+
+    """
+
+    def __init__(self, rect, tile_size=TILE_SIZE, memmap=False,
+                 memmap_dir=None):
+        """
+        Initialize a new TiledStackedImage.
+
+        Arguments:
+            rect: Bounds of the output image. See `StackedImage`.
+            tile_size: Width and height of each tile. Tiles in the last row
+                and column may be smaller.
+            memmap: If True, the output image is memory-mapped onto an
+                anonymous temporary file, rather than held in memory.
+            memmap_dir: Directory in which to create the temporary file. By
+                default the platform's temporary directory is used, which may
+                itself be held in memory.
+
+        """
+        self._rect = _BoundingRect(*rect)
+        self._tile_size = tile_size
+        shape = (int(self._rect.h), int(self._rect.w))
+        if memmap:
+            self._im = numpy.memmap(tempfile.TemporaryFile(dir=memmap_dir),
+                                    dtype=numpy.uint8, mode='w+', shape=shape)
+        else:
+            self._im = numpy.zeros(shape, dtype=numpy.uint8)
+
+    def _tile_bounds(self, row, col):
+        """Return the `(x0, y0, x1, y1)` region of the output for a tile."""
+        t = self._tile_size
+        return (col * t, row * t,
+                min((col + 1) * t, self._im.shape[1]),
+                min((row + 1) * t, self._im.shape[0]))
+
+    def _tiles_in(self, x0, y0, x1, y1):
+        """Return the `(row, col)` keys of tiles overlapping a region."""
+        t = self._tile_size
+        return [(row, col) for row in range(y0 // t, (y1 - 1) // t + 1)
+                           for col in range(x0 // t, (x1 - 1) // t + 1)]
+
+    def tile_rects(self):
+        """
+        Return the tiles, and their bounds in the reference coordinate system.
+
+        Returns:
+            A list of `((row, col), rect)` pairs, where `rect` is an
+            `(x, y, w, h)` tuple suitable for passing to `StackedImage`.
+
+        """
+        t = self._tile_size
+        out = []
+        for row in range((self._im.shape[0] + t - 1) // t):
+            for col in range((self._im.shape[1] + t - 1) // t):
+                x0, y0, x1, y1 = self._tile_bounds(row, col)
+                out.append(((row, col), (self._rect.x + x0, self._rect.y + y0,
+                                         x1 - x0, y1 - y0)))
+        return out
+
+    def tiles_touched(self, shapes, transforms):
+        """
+        Find which input images overlap each tile.
+
+        The corners of all of the images are projected in one batch.
+
+        Arguments:
+            shapes: Sequence of input image `(height, width)` shapes.
+            transforms: Sequence of corresponding transformations, as passed
+                to `add_image`.
+
+        Returns:
+            A dict mapping `(row, col)` tile keys to lists of indices into
+            `shapes`. Tiles which no image overlaps are omitted.
+
+        """
+        out = collections.defaultdict(list)
+        if len(shapes) == 0:
+            return out
+        points = project_corners(shapes, transforms) - [self._rect.x,
+                                                        self._rect.y]
+
+        # As in `_footprint`, allow a pixel either side for interpolation.
+        lo = numpy.floor(points.min(axis=1)).astype(int) - 1
+        hi = numpy.ceil(points.max(axis=1)).astype(int) + 1
+        lo = numpy.maximum(lo, 0)
+        hi = numpy.minimum(hi, [self._im.shape[1], self._im.shape[0]])
+        for idx, ((x0, y0), (x1, y1)) in enumerate(zip(lo.tolist(),
+                                                       hi.tolist())):
+            if x0 < x1 and y0 < y1:
+                for key in self._tiles_in(x0, y0, x1, y1):
+                    out[key].append(idx)
+
+        return out
+
+    def set_tile(self, key, im):
+        """Set a tile of the output image, given its `(row, col)` key."""
+        x0, y0, x1, y1 = self._tile_bounds(*key)
+        self._im[y0:y1, x0:x1] = im
+
+    def add_image(self, im, M):
+        """
+        Add an image to the stack.
+
+        As `StackedImage.add_image`, but the image is warped into each tile
+        that it overlaps separately.
+
+        """
+        footprint = self._footprint(im, M)
+        if footprint is None:
+            return
+        x0, y0, x1, y1 = footprint
+
+        for key in self._tiles_in(x0, y0, x1, y1):
+            tx0, ty0, tx1, ty1 = self._tile_bounds(*key)
+            self._warp_region(im, M, max(x0, tx0), max(y0, ty0),
+                              min(x1, tx1), min(y1, ty1))
@@ -25,9 +25,11 @@ Routine for extracting stars from an input image.
 """
 
 __all__ = (
+    'as_star_set',
     'extract',
     'ExtractFailed',
     'Star',
+    'StarSet',
 )
 
 import collections
@@ -49,7 +51,21 @@ DILATION_SIZE = 9
 MIN_STARS = 8
 MAX_STARS = 50
 
-class Star(collections.namedtuple('_StarBase', ('x', 'y'))):
+# Names of the available star extraction methods. See `extract`.
+METHODS = ('contours', 'components')
+
+class Star(collections.namedtuple('_StarBase', ('x', 'y', 'flux', 'area'))):
+    """
+    A star's position in an image.
+
+    `flux` is the star's integrated brightness (the sum of the pixel values
+    over its region), and `area` is the number of pixels in its region. Either
+    may be None if not known.
+
+    """
+    def __new__(cls, x, y, flux=None, area=None):
+        return super(Star, cls).__new__(cls, x, y, flux, area)
+
     def dist(self, other):
         return math.sqrt((self.x - other.x) ** 2 +
                          (self.y - other.y) ** 2)
@@ -62,32 +78,89 @@ class Star(collections.namedtuple('_StarBase', ('x', 'y'))):
     def pos_vec(self):
         return numpy.matrix([[self.x, self.y]]).T
 
-class ExtractFailed(Exception):
-    pass
+# Record type of `StarSet` arrays. Unknown fluxes are NaN, and unknown areas
+# are -1.
+STAR_DTYPE = numpy.dtype([('x', numpy.float64),
+                          ('y', numpy.float64),
+                          ('flux', numpy.float64),
+                          ('area', numpy.int32)])
 
-def extract(im):
+class StarSet(object):
     """
-    Return an iterable of star coordinates, given an input image.
+    A sequence of stars, stored as a structured array of `STAR_DTYPE`.
 
-    Arguments:
-        im: Image to extract star information from. 2-dimensional input array
-            of uint8 values.
+    This is returned by `extract`, and accepted by `reg` wherever a list of
+    `Star` is. Indexing with an integer, or iterating, gives `Star` objects,
+    whereas indexing with a slice or an index array gives a `StarSet`. The
+    `positions` array can be used to operate on all of the stars at once.
 
-    Return:
-        An iterable of Star objects, corresponding with star positions in the
-        input image.
+    """
+
+    def __init__(self, array):
+        self.array = numpy.asarray(array, dtype=STAR_DTYPE)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Create a StarSet from a sequence of `(x, y[, flux[, area]])` rows, such
+        as `Star` objects, or the output of `tolist`. Missing fluxes and areas
+        may be omitted or None.
+
+        """
+        def row_to_record(row):
+            row = tuple(row) + (None,) * (4 - len(row))
+            return (row[0], row[1],
+                    row[2] if row[2] is not None else numpy.nan,
+                    row[3] if row[3] is not None else -1)
+
+        return cls(numpy.array([row_to_record(row) for row in rows],
+                               dtype=STAR_DTYPE))
+
+    def tolist(self):
+        """Return a list of `[x, y, flux, area]` rows, for serialization."""
+        return [list(s) for s in self]
+
+    @property
+    def positions(self):
+        """An `(N, 2)` array of star positions."""
+        return numpy.column_stack([self.array['x'], self.array['y']])
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, long, numpy.integer)):
+            x, y, flux, area = self.array[idx].tolist()
+            return Star(x=x, y=y,
+                        flux=flux if not math.isnan(flux) else None,
+                        area=area if area >= 0 else None)
+        return StarSet(self.array[idx])
+
+    def __iter__(self):
+        for idx in xrange(len(self.array)):
+            yield self[idx]
+
+    def __repr__(self):
+        return "StarSet({!r})".format(self.array)
+
+def as_star_set(star_list):
+    """Return a `StarSet` of the given stars, copying only if necessary."""
+    if isinstance(star_list, StarSet):
+        return star_list
+    return StarSet.from_rows(star_list)
+
+class ExtractFailed(Exception):
+    pass
+
+def _extract_contours(im, hist=None):
+    """
+    Extract stars by tracing the contour of each region, and computing the
+    moments of each region separately.
 
     """
 
     # Threshold the image to a level which shows a good number of stars.
-    hist = numpy.histogram(im, bins=range(256))[0]
-    for thr in range(256):
-        if sum(hist[thr + 1:]) < (im.shape[0] * im.shape[1] *
-                                  THRESHOLD_FRACTION):
-            break
-    else:
-        raise ExtractFailed("Image too bright")
-    thr += THRESHOLD_BIAS
+    thr = _find_threshold(im, hist) + THRESHOLD_BIAS
     _, thresh_im = cv2.threshold(im, thr, 255, cv2.THRESH_BINARY)
 
     # Dilate the thresholded image so that multiple regions from the same
@@ -106,7 +179,7 @@ def extract(im):
     if len(contours) < MIN_STARS:
         raise ExtractFailed("Not enough stars ({})".format(len(contours)))
 
-    # For each contiguous white region (contour) in the image, yield its
+    # For each contiguous white region (contour) in the image, record its
     # coordinates.  It's coordinates are based on the centre-of-mass of the
     # relevant region.
     # 
@@ -115,6 +188,7 @@ def extract(im):
     #
     # For efficiency, the masking is only applied to a bounding rectangle
     # of the contour.
+    out = numpy.empty(len(contours), dtype=STAR_DTYPE)
     for idx, contour in enumerate(contours):
         x, y, w, h = cv2.boundingRect(contour)
         sub_im_mask = numpy.zeros((h, w), dtype=numpy.uint8)
@@ -127,12 +201,112 @@ def extract(im):
         sub_im = im[y:y + h, x:x + w] * sub_im_mask
         m = cv2.moments(sub_im)
 
-        yield Star(x=(x + m['m10'] / m['m00']), y=(y + m['m01'] / m['m00']))
+        out[idx] = (x + m['m10'] / m['m00'], y + m['m01'] / m['m00'],
+                    m['m00'], numpy.count_nonzero(sub_im_mask))
+
+    return StarSet(out)
+
+def _find_threshold(im, hist=None):
+    """
+    Return the lowest threshold `k` such that fewer than
+    `image_size * THRESHOLD_FRACTION` pixels are brighter than `k`.
+
+    `hist` is the image's histogram, as returned by `frames.compute_stats`. It
+    is computed if not given.
+
+    """
+    if hist is None:
+        hist = cv2.calcHist([im], [0], None, [256], [0, 256])[:, 0]
+
+    # Bins are as for `numpy.histogram(im, bins=range(256))`, ie. the last bin
+    # contains both 254 and 255.
+    hist = numpy.asarray(hist, dtype=int)
+    hist = numpy.append(hist[:254], hist[254:].sum())
+
+    # num_above[k] is the number of pixels in bins above k.
+    num_above = numpy.append(numpy.cumsum(hist[::-1])[::-1][1:], [0, 0])
+    candidates = numpy.flatnonzero(num_above < (im.shape[0] * im.shape[1] *
+                                                THRESHOLD_FRACTION))
+    if len(candidates) == 0:
+        raise ExtractFailed("Image too bright")
+
+    return candidates[0]
+
+def _extract_components(im, hist=None):
+    """
+    Extract stars by labelling connected components, and computing all of the
+    regions' moments in a single pass over the image.
+
+    """
+    thr = _find_threshold(im, hist) + THRESHOLD_BIAS
+    _, thresh_im = cv2.threshold(im, thr, 255, cv2.THRESH_BINARY)
+    thresh_im = cv2.dilate(thresh_im, numpy.ones((DILATION_SIZE,
+                                                  DILATION_SIZE)))
+
+    # Label 0 is the background. As with the contours method, single pixel
+    # regions are discarded.
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+                                                     thresh_im,
+                                                     connectivity=8)
+    keep = numpy.flatnonzero(stats[1:, cv2.CC_STAT_AREA] > 1) + 1
+    if len(keep) > MAX_STARS:
+        raise ExtractFailed("Too many stars ({})".format(len(keep)))
+    if len(keep) < MIN_STARS:
+        raise ExtractFailed("Not enough stars ({})".format(len(keep)))
+
+    # Compute the zeroth and first order moments of the image, masked by each
+    # region. Only pixels inside a region are visited.
+    idx = numpy.flatnonzero(thresh_im)
+    region_labels = labels.ravel()[idx]
+    weights = im.ravel()[idx].astype(numpy.float64)
+    ys, xs = numpy.divmod(idx, im.shape[1])
+    m00 = numpy.bincount(region_labels, weights=weights, minlength=num_labels)
+    m10 = numpy.bincount(region_labels, weights=weights * xs,
+                         minlength=num_labels)
+    m01 = numpy.bincount(region_labels, weights=weights * ys,
+                         minlength=num_labels)
+
+    out = numpy.empty(len(keep), dtype=STAR_DTYPE)
+    out['x'] = m10[keep] / m00[keep]
+    out['y'] = m01[keep] / m00[keep]
+    out['flux'] = m00[keep]
+    out['area'] = stats[keep, cv2.CC_STAT_AREA]
+
+    return StarSet(out)
+
+_METHOD_FUNCS = {
+    'contours': _extract_contours,
+    'components': _extract_components,
+}
+
+def extract(im, method='contours', hist=None):
+    """
+    Return an iterable of star coordinates, given an input image.
+
+    Arguments:
+        im: Image to extract star information from. 2-dimensional input array
+            of uint8 values.
+        method: One of `METHODS`. 'contours' traces each star's region
+            separately, whereas 'components' finds all of the regions and
+            their centroids in a single pass. The results agree to within a
+            small fraction of a pixel, but 'components' is faster. It requires
+            OpenCV 3 or later.
+        hist: Optional histogram of the image, as returned by
+            `frames.compute_stats`. Passing it avoids recomputing it.
+
+    Return:
+        A `StarSet`, corresponding with star positions in the input image.
+
+    """
+    return _METHOD_FUNCS[method](im, hist)
 
 if __name__ == "__main__":
     import sys
 
-    im = cv2.imread(sys.argv[1], cv2.IMREAD_GRAYSCALE)
+    import frames
+    import volume
+
+    im = numpy.array(frames.load_image(sys.argv[1], volume.open_volume()))
 
     for s in extract(im):
         print "{}".format(s)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests for `fetch`, against a local HTTP server.
+
+Run with `python -m unittest test_fetch`.
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+
+import fetch
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves a few canned responses, recording the requests made on each
+    connection in the server's `requests` dict.
+
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body='', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.setdefault(self.client_address, []).append(
+                                                                    self.path)
+            count = sum(paths.count(self.path)
+                            for paths in server.requests.values())
+
+        if self.path == '/redirect':
+            self._send(302, headers=[('Location', '/file/redirected')])
+        elif self.path == '/limited' and count == 1:
+            self._send(429, headers=[('Retry-After', '1')])
+        elif self.path == '/flaky' and count == 1:
+            self._send(503)
+        elif self.path in ('/limited', '/flaky'):
+            self._send(200, body='ok')
+        elif self.path == '/broken':
+            self._send(500)
+        elif self.path.startswith('/file/'):
+            self._send(200, body=self.path[len('/file/'):])
+        else:
+            self._send(404)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = {}
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.fetcher = fetch.Fetcher(rate=1000, concurrency=2, backoff=0.01)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        self.assertEqual(self.fetcher.fetch(self.base_url + '/file/a'), 'a')
+
+    def test_redirect(self):
+        self.assertEqual(self.fetcher.fetch(self.base_url + '/redirect'),
+                         'redirected')
+
+    def test_retry_5xx(self):
+        self.assertEqual(self.fetcher.fetch(self.base_url + '/flaky'), 'ok')
+        self.assertEqual(sum(map(len, self.server.requests.values())), 2)
+
+    def test_retry_429_honours_retry_after(self):
+        start = time.time()
+        self.assertEqual(self.fetcher.fetch(self.base_url + '/limited'),
+                         'ok')
+        self.assertGreaterEqual(time.time() - start, 1.)
+
+    def test_give_up(self):
+        with self.assertRaises(fetch.FetchFailed):
+            self.fetcher.fetch(self.base_url + '/broken')
+        self.assertEqual(sum(map(len, self.server.requests.values())), 4)
+
+    def test_not_found(self):
+        with self.assertRaises(fetch.FetchFailed):
+            self.fetcher.fetch(self.base_url + '/missing')
+
+    def test_request_budget(self):
+        fetcher = fetch.Fetcher(rate=1000, max_requests=3)
+        for i in range(2):
+            fetcher.fetch(self.base_url + '/file/a')
+        with self.assertRaises(AssertionError):
+            fetcher.fetch(self.base_url + '/file/a')
+
+        fetcher.reset_request_count()
+        self.assertEqual(fetcher.fetch(self.base_url + '/file/a'), 'a')
+
+    def test_map_reuses_connections(self):
+        for call in range(3):
+            names = [str(i) for i in range(call * 4, (call + 1) * 4)]
+            results = self.fetcher.map(
+                   lambda name: self.fetcher.fetch(
+                                    '{}/file/{}'.format(self.base_url, name)),
+                   names)
+            self.assertEqual(sorted(results), sorted(names))
+
+        # Each of the `map` threads keeps a single connection across calls.
+        self.assertLessEqual(len(self.server.requests), 2)
+        self.assertEqual(sum(map(len, self.server.requests.values())), 12)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A memory-mapped volume of decoded input frames.
+
+"""
+
+__all__ = (
+    'FrameVolume',
+    'open_volume',
+)
+
+import json
+import os
+
+import cv2
+import numpy
+
+import frames
+
+_VOLUME_FILE = "data/images/input/frames.vol"
+_INDEX_FILE = "data/images/input/frames.json"
+
+class FrameVolume(object):
+    """
+    Decoded grayscale frames, packed end-to-end into a single file.
+
+    An index maps each frame's timestamp to its offset and shape within the
+    file, and to the path and `frames.file_id` of the image it was decoded
+    from. A frame is only considered to be held if its image is unchanged
+    since it was decoded. Frames are read through `numpy.memmap`, so loading
+    a frame does not copy or decode anything. New frames (including new
+    versions of changed images) are appended to the end of the file, so
+    adding frames never rewrites existing ones.
+
+    """
+
+    def __init__(self, path=_VOLUME_FILE, index_path=_INDEX_FILE):
+        self._path = path
+        self._index_path = index_path
+        self._mmap = None
+
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self._index = json.load(f)
+        else:
+            self._index = {}
+        self._paths = {entry['image_path']: timestamp
+                            for timestamp, entry in self._index.items()}
+
+    def __contains__(self, timestamp):
+        entry = self._index.get(str(timestamp))
+        if entry is None:
+            return False
+        try:
+            return entry.get('file_id') == frames.file_id(entry['image_path'])
+        except OSError:
+            return False
+
+    def __len__(self):
+        return len(self._index)
+
+    def has_path(self, image_path):
+        """Return True if the volume holds the frame for an image path."""
+        return (image_path in self._paths and
+                self._paths[image_path] in self)
+
+    def load(self, timestamp):
+        """
+        Return a read-only, memory-mapped view of the frame with a given
+        timestamp.
+
+        """
+        entry = self._index[str(timestamp)]
+        if self._mmap is None:
+            self._mmap = numpy.memmap(self._path, dtype=numpy.uint8, mode='r')
+        h, w = entry['shape']
+        return self._mmap[entry['offset']:
+                                 entry['offset'] + h * w].reshape((h, w))
+
+    def load_path(self, image_path):
+        """As `load`, but look the frame up by the path of its image."""
+        return self.load(self._paths[image_path])
+
+    def append(self, timestamp, image_path, im=None):
+        """
+        Append a frame to the volume.
+
+        Arguments:
+            timestamp: Timestamp of the frame, as in the metadata.
+            image_path: Path of the image which the frame was decoded from.
+            im: The decoded frame. If None, `image_path` is decoded.
+
+        `IOError` is raised if the image can't be decoded.
+
+        """
+        self._append(timestamp, image_path, im)
+        self._save_index()
+
+    def _append(self, timestamp, image_path, im):
+        file_id = frames.file_id(image_path)
+        if im is None:
+            im = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if im is None:
+                raise IOError("Failed to decode {}".format(image_path))
+
+        # Data is written before the index, so a crash at worst leaves unused
+        # bytes at the end of the file.
+        with open(self._path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(numpy.ascontiguousarray(im, dtype=numpy.uint8).tobytes())
+        self._mmap = None
+
+        self._index[str(timestamp)] = {
+            'offset': offset,
+            'shape': list(im.shape),
+            'image_path': image_path,
+            'file_id': file_id,
+        }
+        self._paths[image_path] = str(timestamp)
+
+    def update(self, metadata):
+        """
+        Append the frames for any metadata records not in the volume.
+
+        Images which can't be decoded are skipped.
+
+        Returns:
+            The number of frames appended.
+
+        """
+        num_appended = 0
+        for d in metadata:
+            if d['timestamp'] in self:
+                continue
+            try:
+                self._append(d['timestamp'], d['image_path'], None)
+            except IOError as e:
+                print "Not packing {}: {}".format(d['image_path'], e)
+                continue
+            num_appended += 1
+        if num_appended:
+            self._save_index()
+
+        return num_appended
+
+    def _save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.rename(tmp_path, self._index_path)
+
+def open_volume():
+    """Return the default `FrameVolume`, or None if it has not been created."""
+    if not os.path.exists(_INDEX_FILE):
+        return None
+    return FrameVolume()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+# Copyright (c) 2015 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Routines for writing output images.
+
+"""
+
+__all__ = (
+    'apply_black_cutoff',
+    'FORMATS',
+    'ImageWriter',
+)
+
+import Queue
+import threading
+import time
+
+import cv2
+import numpy
+
+# Output formats supported by `ImageWriter`. PGM is uncompressed, so it is much
+# faster to write than PNG, at the expense of file size.
+FORMATS = ('png', 'pgm')
+
+def apply_black_cutoff(im, cutoff):
+    """
+    Set pixels with a value of `cutoff` or less to 0, in place.
+
+    This is done with a lookup table, so no temporary images are allocated.
+    A negative `cutoff` leaves the image unchanged.
+
+    """
+    lut = numpy.arange(256, dtype=numpy.uint8)
+    lut[:min(max(cutoff + 1, 0), 256)] = 0
+    cv2.LUT(im, lut, dst=im)
+
+    return im
+
+class ImageWriter(object):
+    """
+    Writes images on a background thread.
+
+    Encoding an image (particularly as PNG) is slow, so doing it on a separate
+    thread allows it to overlap with producing the next image. The number of
+    images waiting to be written is bounded, so memory use stays bounded if
+    images are produced faster than they can be written.
+
+    `write_times` lists the time taken to write each image so far, in seconds,
+    in the order the images were queued.
+
+    """
+
+    def __init__(self, fmt='png', png_compression=3, max_queued=2,
+                 animation=None):
+        """
+        Initialize a new ImageWriter.
+
+        Arguments:
+            fmt: One of `FORMATS`. This determines the extension of the
+                written files.
+            png_compression: PNG compression level, 0 (fastest) to 9
+                (smallest).
+            max_queued: Maximum number of images waiting to be written before
+                `write` blocks.
+            animation: Optional animation writer, such as one returned by
+                `anim.open_animation`. Each image is also added to it as a
+                frame, in the order they were queued. It is closed by
+                `close`.
+
+        """
+        self._animation = animation
+        if fmt not in FORMATS:
+            raise ValueError("Unsupported format {}".format(fmt))
+        self.fmt = fmt
+        self._params = ([cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+                                                       if fmt == 'png' else [])
+        self._queue = Queue.Queue(maxsize=max_queued)
+        self._error = None
+        self.write_times = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, im = item
+            start = time.time()
+            try:
+                if path is not None and not cv2.imwrite(path, im,
+                                                        self._params):
+                    raise IOError("Failed to write {}".format(path))
+                if self._animation is not None:
+                    self._animation.add_frame(im)
+            except Exception as e:
+                self._error = e
+            self.write_times.append(time.time() - start)
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, path, im):
+        """
+        Queue an image to be written.
+
+        `path` should have no extension. The extension for the format is
+        added, and the full path is returned. If `path` is None, the image is
+        only added to the animation. Errors from writing previously queued
+        images are raised here.
+
+        """
+        self._check_error()
+        if path is not None:
+            path = "{}.{}".format(path, self.fmt)
+        self._queue.put((path, im))
+
+        return path
+
+    def close(self):
+        """Wait for all queued images to be written."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._animation is not None:
+            self._animation.close()
+        self._check_error()